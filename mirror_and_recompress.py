@@ -3,23 +3,173 @@
 from __future__ import annotations
 
 import argparse
+import bz2
+import collections
 import concurrent.futures
+import contextlib
+import ctypes
 import dataclasses
+import errno
+import fcntl
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import lzma
 import os
+import queue
+import re
+import select
 import shlex
 import shutil
+import signal
+import sqlite3
 import stat
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import zlib
 from enum import Enum
-from typing import BinaryIO, Callable, Iterator, Optional
+from typing import BinaryIO, Callable, Iterator, Optional, Protocol, TextIO
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 SCRIPT_PATH = os.path.realpath(__file__)
 SCRIPT_NAME = os.path.basename(sys.argv[0])
 CHUNK_SIZE = 1024 * 1024
+PIPE_BUFFER_SIZE = 1024 * 1024
+COMPARE_CHUNK_SIZE = 4 * 1024 * 1024
+PROBE_MAX_READS = 64
+INDEXED_SIZE_CODECS = ("none", "xz", "lzma")
+PROBE_MAX_INDEX_SIZE = 16 * 1024 * 1024
+ZSTD_FRAME_MAGIC = 0xFD2FB528
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+XZ_STREAM_MAGIC = b"\xfd7zXZ\x00"
+LZMA_UNKNOWN_SIZE = 0xFFFFFFFFFFFFFFFF
+FICLONE = 0x40049409
+PASSTHROUGH_MODES = ("off", "copy", "test")
+REMOTE_TRANSPORTS = ("shared", "stream")
+INCOMPRESSIBLE_MODES = ("off", "fast")
+CONCATENATED_CODECS = ("gzip", "bzip2", "xz", "lz4", "zstd", "lzip")
+KERNEL_COPY_FALLBACK_ERRORS = (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EBADF)
+MANIFEST_NAME = ".mirror_manifest.sqlite"
+MANIFEST_SCHEMA_VERSION = 2
+CONTENT_HASH_DIGEST_SIZE = 16
+MANIFEST_COMMIT_INTERVAL = 1000
+JOURNAL_NAME = ".mirror_journal.jsonl"
+JOURNALED_ACTIONS = ("converted", "verified", "deleted")
+DEFAULT_SCAN_JOBS = 8
+SCAN_LOOKAHEAD_FACTOR = 4
+BROTLI_INPUT_CHUNK = 64 * 1024
+BATCH_SMALL_FILE_SIZE = 256 * 1024
+BATCH_MAX_BYTES = 4 * 1024 * 1024
+BATCH_MAX_ITEMS = 64
+SCHEDULES = ("lex", "largest-first")
+DEFAULT_LOOKAHEAD = 1024
+LEVEL_OPT_RE = re.compile(r"-(\d+)")
+THREADS_OPT_RE = re.compile(r"(?:-T|--threads=)(\d+)")
+LONG_OPT_RE = re.compile(r"--long(?:=(\d+))?")
+TEMP_OUTPUT_RE = re.compile(r"\.(.+)\.[a-z0-9_]{8}\.tmp")
+HOST_LINE_RE = re.compile(r"(?:(\d+)/)?(.+)")
+FRAME_HEADER = struct.Struct("!cII")
+FRAME_CONFIG = b"C"
+FRAME_READY = b"R"
+FRAME_BATCH = b"B"
+FRAME_OUTCOMES = b"O"
+FRAME_ERROR = b"E"
+FRAME_STREAM = b"S"
+FRAME_DATA = b"D"
+FRAME_FINISHED = b"F"
+SIZE_RE = re.compile(r"(\d+(?:\.\d+)?)\s*([kmgtp]?)i?b?", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40, "p": 1 << 50}
+MIB = 1 << 20
+MB = 1000 * 1000
+ADAPTIVE_TRIAL_MIN_SIZE = 16 * MIB
+ADAPTIVE_SAMPLE_SIZE = 2 * MIB
+INCOMPRESSIBLE_MIN_SIZE = 64 * 1024
+MIN_BLOCK_SIZE = 64 * 1024
+BLOCK_IN_FLIGHT_FACTOR = 2
+PARALLEL_DECODE_MIN_SIZE = 16 * 1024 * 1024
+PARALLEL_DECODE_CHUNK_SIZE = 8 * 1024 * 1024
+PARALLEL_DECODE_MAX_MEMBER = 64 * 1024 * 1024
+THREADED_DECODERS = ("xz",)
+IO_BURST_SECONDS = 0.5
+DEFAULT_IN_FLIGHT_PER_JOB = 256 * MIB
+IN_FLIGHT_BATCHES_PER_JOB = 8
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+DEFAULT_INCOMPRESSIBLE_RATIO = 0.95
+DEFAULT_METRICS_INTERVAL = 15.0
+RATE_WINDOW_SECONDS = 30.0
+DEFAULT_WATCH_DEBOUNCE = 2.0
+DEFAULT_WATCH_INTERVAL = 10.0
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 64 * 1024
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+METRICS_PREFIX = "mirror_recompress"
+
+
+class StreamCompressor(Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+class ContentHasher(Protocol):
+    def update(self, data: bytes) -> None: ...
+
+    def hexdigest(self) -> str: ...
+
+
+@dataclasses.dataclass(frozen=True)
+class CodecResources:
+    default_level: int
+    memory_mib: tuple[int, ...]
+    threaded: bool = False
+
+    def memory_for_level(self, level: int) -> int:
+        return self.memory_mib[min(max(level, 0), len(self.memory_mib) - 1)] * MIB
+
+
+@dataclasses.dataclass(frozen=True)
+class ResourceCost:
+    threads: int
+    memory: int
+
+
+@dataclasses.dataclass(frozen=True)
+class InProcessCodec:
+    levels: range
+    default_level: int
+    compressor: Callable[[int], StreamCompressor]
+    reader: Callable[[BinaryIO], BinaryIO]
 
 
 @dataclasses.dataclass(frozen=True)
@@ -31,6 +181,8 @@ class Codec:
     decompressor_binary: str
     compressor_args: Optional[Callable[[list[str]], list[str]]]
     decompressor_args: Optional[Callable[[str], list[str]]]
+    resources: CodecResources
+    in_process: Optional[InProcessCodec] = None
 
     def compress_command(self, opts: list[str]) -> list[str]:
         if self.compressor_args is None:
@@ -51,6 +203,8 @@ def codec(
     decompressor_binary: str,
     compressor_args: Optional[Callable[[list[str]], list[str]]],
     decompressor_args: Optional[Callable[[str], list[str]]],
+    resources: CodecResources,
+    in_process: Optional[InProcessCodec] = None,
 ) -> Codec:
     return Codec(
         name=name,
@@ -60,20 +214,103 @@ def codec(
         decompressor_binary=decompressor_binary,
         compressor_args=compressor_args,
         decompressor_args=decompressor_args,
+        resources=resources,
+        in_process=in_process,
     )
 
 
+class BrotliCompressor:
+    def __init__(self, level: int) -> None:
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.finish()
+
+
+class BrotliReader(io.RawIOBase):
+    def __init__(self, fh: BinaryIO) -> None:
+        self.fh = fh
+        self.decompressor = brotli.Decompressor()
+        self.pending = b""
+        self.offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray | memoryview) -> int:
+        while self.offset >= len(self.pending):
+            if self.decompressor.is_finished():
+                return 0
+            data = self.fh.read(BROTLI_INPUT_CHUNK)
+            if not data:
+                raise EOFError("compressed brotli stream ended before the end-of-stream marker")
+            self.pending = self.decompressor.process(data)
+            self.offset = 0
+        count = min(len(buffer), len(self.pending) - self.offset)
+        buffer[:count] = self.pending[self.offset : self.offset + count]
+        self.offset += count
+        return count
+
+
+def zstd_reader(fh: BinaryIO) -> BinaryIO:
+    return zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True, closefd=False)
+
+
+GZIP_IN_PROCESS = InProcessCodec(range(1, 10), 6, lambda level: zlib.compressobj(level, zlib.DEFLATED, 31), lambda fh: gzip.GzipFile(fileobj=fh, mode="rb"))
+BZIP2_IN_PROCESS = InProcessCodec(range(1, 10), 9, lambda level: bz2.BZ2Compressor(level), lambda fh: bz2.BZ2File(fh))
+XZ_IN_PROCESS = InProcessCodec(
+    range(0, 10),
+    6,
+    lambda level: lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=level),
+    lambda fh: lzma.LZMAFile(fh, format=lzma.FORMAT_XZ),
+)
+LZMA_IN_PROCESS = InProcessCodec(
+    range(0, 10),
+    6,
+    lambda level: lzma.LZMACompressor(format=lzma.FORMAT_ALONE, preset=level),
+    lambda fh: lzma.LZMAFile(fh, format=lzma.FORMAT_ALONE),
+)
+ZSTD_IN_PROCESS = (
+    InProcessCodec(range(1, 20), 3, lambda level: zstandard.ZstdCompressor(level=level, write_checksum=True).compressobj(), zstd_reader)
+    if zstandard is not None
+    else None
+)
+BROTLI_IN_PROCESS = InProcessCodec(range(0, 12), 11, BrotliCompressor, lambda fh: io.BufferedReader(BrotliReader(fh), CHUNK_SIZE)) if brotli is not None else None
+
+ADAPTIVE_LEVELS = {
+    "gzip": (1, 3, 6, 9),
+    "bzip2": (1, 5, 9),
+    "xz": (0, 1, 3, 6, 9),
+    "lzma": (0, 1, 3, 6, 9),
+    "lz4": (1, 4, 9, 12),
+    "zstd": (1, 3, 6, 12, 19),
+    "brotli": (1, 4, 7, 9, 11),
+    "lzip": (0, 3, 6, 9),
+}
+COPY_RESOURCES = CodecResources(0, (1,))
+SMALL_RESOURCES = CodecResources(6, (1,))
+BZIP2_RESOURCES = CodecResources(9, (1, 2, 2, 3, 4, 5, 5, 6, 7, 8))
+XZ_RESOURCES = CodecResources(6, (3, 9, 17, 32, 48, 94, 94, 186, 370, 674), threaded=True)
+LZMA_RESOURCES = CodecResources(6, (3, 9, 17, 32, 48, 94, 94, 186, 370, 674))
+ZSTD_RESOURCES = CodecResources(3, (1, 2, 6, 10, 12, 16, 20, 24, 28, 32, 36, 40, 48, 64, 64, 72, 96, 128, 160, 192, 400, 800, 1400), threaded=True)
+BROTLI_RESOURCES = CodecResources(11, (1, 2, 2, 3, 4, 5, 6, 8, 10, 12, 80, 80))
+LZIP_RESOURCES = CodecResources(6, (3, 12, 20, 36, 52, 100, 100, 196, 388, 676))
+
+
 CODECS: dict[str, Codec] = {
-    "none": codec("none", "", (), "cat", "cat", None, None),
-    "gzip": codec("gzip", ".gz", (".tar.gz", ".tgz", ".gz"), "gzip", "gzip", lambda opts: ["gzip", *opts, "-c"], lambda path: ["gzip", "-d", "-c", "--", path]),
-    "bzip2": codec("bzip2", ".bz2", (".tar.bz2", ".tbz2", ".bz2"), "bzip2", "bzip2", lambda opts: ["bzip2", *opts, "-c"], lambda path: ["bzip2", "-d", "-c", "--", path]),
-    "xz": codec("xz", ".xz", (".tar.xz", ".txz", ".xz"), "xz", "xz", lambda opts: ["xz", *opts, "-c"], lambda path: ["xz", "-d", "-c", "--", path]),
-    "lzma": codec("lzma", ".lzma", (".lzma",), "xz", "xz", lambda opts: ["xz", "--format=lzma", *opts, "-c"], lambda path: ["xz", "--format=lzma", "-d", "-c", "--", path]),
-    "lz4": codec("lz4", ".lz4", (".lz4",), "lz4", "lz4", lambda opts: ["lz4", "-q", *opts, "-c"], lambda path: ["lz4", "-q", "-d", "-c", "--", path]),
-    "zstd": codec("zstd", ".zst", (".tar.zst", ".tzst", ".zst", ".zstd"), "zstd", "zstd", lambda opts: ["zstd", "-q", *opts, "-c"], lambda path: ["zstd", "-q", "-d", "-c", "--", path]),
-    "brotli": codec("brotli", ".br", (".br",), "brotli", "brotli", lambda opts: ["brotli", *opts, "-c"], lambda path: ["brotli", "-d", "-c", "--", path]),
-    "lzip": codec("lzip", ".lz", (".lz",), "lzip", "lzip", lambda opts: ["lzip", *opts, "-c"], lambda path: ["lzip", "-d", "-c", "--", path]),
-    "compress": codec("compress", ".Z", (".Z",), "compress", "gzip", lambda opts: ["compress", *opts, "-c"], lambda path: ["gzip", "-d", "-c", "--", path]),
+    "none": codec("none", "", (), "cat", "cat", None, None, COPY_RESOURCES),
+    "gzip": codec("gzip", ".gz", (".tar.gz", ".tgz", ".gz"), "gzip", "gzip", lambda opts: ["gzip", *opts, "-c"], lambda path: ["gzip", "-d", "-c", "--", path], SMALL_RESOURCES, GZIP_IN_PROCESS),
+    "bzip2": codec("bzip2", ".bz2", (".tar.bz2", ".tbz2", ".bz2"), "bzip2", "bzip2", lambda opts: ["bzip2", *opts, "-c"], lambda path: ["bzip2", "-d", "-c", "--", path], BZIP2_RESOURCES, BZIP2_IN_PROCESS),
+    "xz": codec("xz", ".xz", (".tar.xz", ".txz", ".xz"), "xz", "xz", lambda opts: ["xz", *opts, "-c"], lambda path: ["xz", "-d", "-c", "--", path], XZ_RESOURCES, XZ_IN_PROCESS),
+    "lzma": codec("lzma", ".lzma", (".lzma",), "xz", "xz", lambda opts: ["xz", "--format=lzma", *opts, "-c"], lambda path: ["xz", "--format=lzma", "-d", "-c", "--", path], LZMA_RESOURCES, LZMA_IN_PROCESS),
+    "lz4": codec("lz4", ".lz4", (".lz4",), "lz4", "lz4", lambda opts: ["lz4", "-q", *opts, "-c"], lambda path: ["lz4", "-q", "-d", "-c", "--", path], SMALL_RESOURCES),
+    "zstd": codec("zstd", ".zst", (".tar.zst", ".tzst", ".zst", ".zstd"), "zstd", "zstd", lambda opts: ["zstd", "-q", *opts, "-c"], lambda path: ["zstd", "-q", "-d", "-c", "--", path], ZSTD_RESOURCES, ZSTD_IN_PROCESS),
+    "brotli": codec("brotli", ".br", (".br",), "brotli", "brotli", lambda opts: ["brotli", *opts, "-c"], lambda path: ["brotli", "-d", "-c", "--", path], BROTLI_RESOURCES, BROTLI_IN_PROCESS),
+    "lzip": codec("lzip", ".lz", (".lz",), "lzip", "lzip", lambda opts: ["lzip", *opts, "-c"], lambda path: ["lzip", "-d", "-c", "--", path], LZIP_RESOURCES),
+    "compress": codec("compress", ".Z", (".Z",), "compress", "gzip", lambda opts: ["compress", *opts, "-c"], lambda path: ["gzip", "-d", "-c", "--", path], SMALL_RESOURCES),
 }
 
 
@@ -98,6 +335,8 @@ STRIP_SUFFIXES = sorted(
     reverse=True,
 )
 STAT_ORDER = ("converted", "verified", "retained", "deleted", "total")
+STAGE_ORDER = ("scan", "reconcile", "verify", "decompress", "compress", "copy", "finalize", "copystat")
+TRACED_STAGES = ("verify", "convert", "copy", "finalize", "copystat")
 
 
 class OutcomeAction(str, Enum):
@@ -123,9 +362,42 @@ class Config:
     compress_opts: list[str]
     target_suffix: str
     hosts_file: str
+    remote_transport: str
     jobs: Optional[int]
+    scan_jobs: int
+    schedule: str
+    lookahead: int
+    max_threads: int
+    max_memory: Optional[int]
     delete_extra: bool
     compare_bytes: bool
+    manifest: bool
+    scrub: bool
+    resume: bool
+    prescan: bool
+    watch: bool
+    in_process: bool
+    passthrough: str
+    target_throughput: Optional[float]
+    adaptive_levels: list[int]
+    incompressible: str
+    incompressible_ratio: float
+    block_size: Optional[int]
+    decode_threads: int
+    read_limit: Optional[float]
+    write_limit: Optional[float]
+    iops_limit: Optional[float]
+    nice: Optional[int]
+    ionice: str
+    in_flight_high: Optional[int]
+    in_flight_low: Optional[int]
+    trace: str
+    trace_jsonl: str
+    metrics_textfile: str
+    metrics_json: str
+    metrics_interval: float
+    watch_debounce: float
+    watch_interval: float
     dry_run: bool
     verbose: bool
     quiet: bool
@@ -139,9 +411,42 @@ class ConfigValues:
     compress_opts: list[str]
     target_suffix: str
     hosts_file: str
+    remote_transport: str
     jobs: Optional[int]
+    scan_jobs: Optional[int]
+    schedule: str
+    lookahead: Optional[int]
+    max_threads: Optional[int]
+    max_memory: str
     delete_extra: bool
     compare_bytes: bool
+    manifest: bool
+    scrub: bool
+    resume: bool
+    prescan: bool
+    watch: bool
+    in_process: bool
+    passthrough: str
+    target_throughput: str
+    adaptive_levels: str
+    incompressible: str
+    incompressible_ratio: str
+    block_size: str
+    decode_threads: Optional[int]
+    read_limit: str
+    write_limit: str
+    iops_limit: str
+    nice: Optional[int]
+    ionice: str
+    in_flight_high: str
+    in_flight_low: str
+    trace: str
+    trace_jsonl: str
+    metrics_textfile: str
+    metrics_json: str
+    metrics_interval: str
+    watch_debounce: str
+    watch_interval: str
     dry_run: bool
     verbose: bool
     quiet: bool
@@ -167,12 +472,73 @@ class TargetSnapshot:
     mtime_ns: int
 
 
+@dataclasses.dataclass(frozen=True)
+class ManifestEntry:
+    source_rel: str
+    source_size: int
+    source_mtime_ns: int
+    codec: str
+    compress_opts: str
+    target_rel: str
+    target_size: int
+    uncompressed_size: Optional[int]
+    content_hash: Optional[str]
+
+
+@dataclasses.dataclass
+class PendingScan:
+    path: str
+    rel_path: str
+    future: Optional[concurrent.futures.Future[tuple[list[os.DirEntry[str]], list[os.DirEntry[str]]]]] = None
+
+
+@dataclasses.dataclass(frozen=True)
+class WorkerHost:
+    login: str
+    slots: Optional[int]
+
+    def command(self) -> list[str]:
+        worker = [SCRIPT_PATH, "--worker"]
+        if self.login == ":":
+            return [sys.executable, *worker]
+        *ssh, host = shlex.split(self.login)
+        return [*(ssh or ["ssh"]), host, shlex.join(worker)]
+
+
+@dataclasses.dataclass
+class StreamedOutput:
+    task: FileTask
+    tmp_path: str
+    fh: BinaryIO
+
+
+@dataclasses.dataclass(frozen=True)
+class ContainerMember:
+    offset: int
+    length: int
+    uncompressed_size: Optional[int]
+
+
+@dataclasses.dataclass(frozen=True)
+class BlockSettings:
+    size: int
+    workers: int
+
+
+@dataclasses.dataclass(frozen=True)
+class LevelPolicy:
+    min_speed: float
+    fallback_level: int
+
+
 @dataclasses.dataclass(frozen=True)
 class WorkItem:
     action: WorkAction
     reason: str
     task: Optional[FileTask] = None
     target: Optional[TargetSnapshot] = None
+    manifest: Optional[ManifestEntry] = None
+    level_policy: Optional[LevelPolicy] = None
 
 
 @dataclasses.dataclass(frozen=True)
@@ -185,6 +551,11 @@ class TaskOutcome:
     input_size: Optional[int] = None
     output_size: Optional[int] = None
     uncompressed_size: Optional[int] = None
+    source_mtime_ns: Optional[int] = None
+    content_hash: Optional[str] = None
+    encoding: str = ""
+    timings: dict[str, list[float]] = dataclasses.field(default_factory=dict)
+    trace: list[dict] = dataclasses.field(default_factory=list)
 
 
 @dataclasses.dataclass
@@ -215,12 +586,223 @@ class StatsBucket:
         setattr(self, attr, getattr(self, attr) + value)
 
 
+class StageTimings:
+    def __init__(self, traced: bool = False) -> None:
+        self.lock = threading.Lock()
+        self.totals: dict[str, list[float]] = {}
+        self.spans: Optional[list[list]] = [] if traced else None
+        self.started_ns = time.time_ns()
+        self.started = time.perf_counter()
+
+    def add(self, stage: str, wall: float, cpu: float, count: int = 1) -> None:
+        with self.lock:
+            entry = self.totals.setdefault(stage, [0, 0.0, 0.0])
+            entry[0] += count
+            entry[1] += wall
+            entry[2] += cpu
+
+    def merge(self, totals: dict[str, list[float]]) -> None:
+        for stage, (_, wall, cpu) in totals.items():
+            self.add(stage, wall, cpu)
+
+    @contextlib.contextmanager
+    def measure(self, stage: str, count: int = 1) -> Iterator[None]:
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - wall
+            self.add(stage, elapsed, time.thread_time() - cpu, count)
+            if self.spans is not None and stage in TRACED_STAGES:
+                self.record_span(stage, wall, elapsed)
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        if self.spans is None:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, started, time.perf_counter() - started)
+
+    def record_span(self, name: str, started: float, elapsed: float) -> None:
+        assert self.spans is not None
+        offset_us = (started - self.started) * 1e6
+        with self.lock:
+            self.spans.append([name, self.started_ns // 1000 + int(offset_us), int(elapsed * 1e6)])
+
+    def trace_payload(self) -> list[dict]:
+        if self.spans is None:
+            return []
+        self.record_span("item", self.started, time.perf_counter() - self.started)
+        return [{"worker": worker_id(), "spans": self.spans}]
+
+
+class StageClock:
+    def __init__(self) -> None:
+        self.local = threading.local()
+
+    def current(self) -> Optional[StageTimings]:
+        return getattr(self.local, "timings", None)
+
+    @contextlib.contextmanager
+    def collect(self, timings: StageTimings) -> Iterator[StageTimings]:
+        previous = self.current()
+        self.local.timings = timings
+        try:
+            yield timings
+        finally:
+            self.local.timings = previous
+
+    def measure(self, stage: str) -> contextlib.AbstractContextManager[None]:
+        timings = self.current()
+        return timings.measure(stage) if timings is not None else contextlib.nullcontext()
+
+    def span(self, name: str) -> contextlib.AbstractContextManager[None]:
+        timings = self.current()
+        return timings.span(name) if timings is not None else contextlib.nullcontext()
+
+    def record_cpu(self, stage: str, cpu: float) -> None:
+        timings = self.current()
+        if timings is not None:
+            timings.add(stage, 0.0, cpu, count=0)
+
+    def bind(self, stage: str, func: Callable[..., bytes]) -> Callable[..., bytes]:
+        timings = self.current()
+        if timings is None:
+            return func
+
+        def run(*args: object, **kwargs: object) -> bytes:
+            cpu = time.thread_time()
+            with self.collect(timings):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    timings.add(stage, 0.0, time.thread_time() - cpu, count=0)
+
+        return run
+
+
+STAGE_CLOCK = StageClock()
+
+
+def worker_id() -> str:
+    return f"{os.uname().nodename}/{os.getpid()}/{threading.current_thread().name}"
+
+
+def trace_enabled(config: Config) -> bool:
+    return bool(config.trace or config.trace_jsonl)
+
+
+class RunTrace:
+    def __init__(self, chrome_fh: Optional[TextIO], jsonl_fh: Optional[TextIO]) -> None:
+        self.chrome_fh = chrome_fh
+        self.jsonl_fh = jsonl_fh
+        self.processes: dict[str, int] = {}
+        self.threads: dict[str, tuple[int, int]] = {}
+        self.separator = ""
+        if chrome_fh is not None:
+            chrome_fh.write("[\n")
+
+    def thread_ids(self, worker: str) -> tuple[int, int]:
+        ids = self.threads.get(worker)
+        if ids is not None:
+            return ids
+        process, _, thread = worker.rpartition("/")
+        pid = self.processes.get(process)
+        if pid is None:
+            pid = self.processes[process] = len(self.processes) + 1
+            self.write_chrome({"ph": "M", "name": "process_name", "pid": pid, "tid": 0, "args": {"name": process}})
+        ids = self.threads[worker] = (pid, len(self.threads) + 1)
+        self.write_chrome({"ph": "M", "name": "thread_name", "pid": pid, "tid": ids[1], "args": {"name": thread}})
+        return ids
+
+    def write_chrome(self, event: dict) -> None:
+        if self.chrome_fh is None:
+            return
+        self.chrome_fh.write(self.separator + json.dumps(event))
+        self.separator = ",\n"
+
+    def emit(self, worker: str, name: str, ts: int, dur: int, args: dict) -> None:
+        pid, tid = self.thread_ids(worker)
+        event = {"name": name, "cat": "item" if name == "item" else "stage", "ph": "X", "ts": ts, "dur": dur, "pid": pid, "tid": tid, "args": args}
+        self.write_chrome(event)
+        if self.jsonl_fh is not None:
+            self.jsonl_fh.write(json.dumps({**event, "worker": worker}) + "\n")
+
+    def record_outcome(self, outcome: TaskOutcome, compressor: str) -> None:
+        args = {
+            "source": outcome.source_rel,
+            "action": outcome.action.value,
+            "codec": f"{outcome.input_format}->{compressor}" if outcome.input_format else compressor,
+            "input_bytes": outcome.input_size,
+            "output_bytes": outcome.output_size,
+        }
+        for payload in outcome.trace:
+            for name, ts, dur in payload["spans"]:
+                self.emit(payload["worker"], name, ts, dur, args)
+
+    @contextlib.contextmanager
+    def span(self, name: str, args: Optional[dict] = None) -> Iterator[None]:
+        started_ns = time.time_ns()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.emit(worker_id(), name, started_ns // 1000, int((time.perf_counter() - started) * 1e6), args or {})
+
+    def close(self) -> None:
+        if self.chrome_fh is not None:
+            self.chrome_fh.write("\n]\n")
+            self.chrome_fh.close()
+        if self.jsonl_fh is not None:
+            self.jsonl_fh.close()
+
+
+def open_run_trace(config: Config) -> Optional[RunTrace]:
+    if not trace_enabled(config):
+        return None
+    try:
+        chrome_fh = open(config.trace, "w", encoding="utf-8") if config.trace else None
+        jsonl_fh = open(config.trace_jsonl, "w", encoding="utf-8") if config.trace_jsonl else None
+    except OSError as exc:
+        die(f"cannot open trace file: {exc}")
+    return RunTrace(chrome_fh, jsonl_fh)
+
+
 class StatsAccumulator:
     def __init__(self) -> None:
         self.buckets = {status: StatsBucket() for status in STAT_ORDER}
+        self.encodings: dict[str, int] = {}
+        self.stages = StageTimings()
+        self.decoded: dict[str, list[float]] = {}
+        self.encoded = [0, 0, 0, 0.0]
 
     def add(self, outcome: TaskOutcome) -> None:
         self.buckets[outcome.action.value].add(outcome)
+        if outcome.action == OutcomeAction.CONVERTED and outcome.encoding:
+            self.encodings[outcome.encoding] = self.encodings.get(outcome.encoding, 0) + 1
+        if not outcome.timings:
+            return
+        self.stages.merge(outcome.timings)
+        if outcome.action != OutcomeAction.CONVERTED or outcome.encoding == "passthrough":
+            return
+        uncompressed_size = outcome.uncompressed_size or 0
+        if "decompress" in outcome.timings:
+            decoded = self.decoded.setdefault(outcome.input_format, [0, 0, 0, 0.0])
+            self._add_rate(decoded, outcome.input_size or 0, uncompressed_size, outcome.timings["decompress"][2])
+        if "compress" in outcome.timings:
+            self._add_rate(self.encoded, uncompressed_size, outcome.output_size or 0, outcome.timings["compress"][2])
+
+    @staticmethod
+    def _add_rate(entry: list[float], bytes_in: int, bytes_out: int, cpu: float) -> None:
+        entry[0] += 1
+        entry[1] += bytes_in
+        entry[2] += bytes_out
+        entry[3] += cpu
 
     def compute_total(self) -> None:
         total = StatsBucket()
@@ -243,7 +825,7 @@ class StatsAccumulator:
             ("converted", self.buckets["converted"], True),
             ("verified", self.buckets["verified"], True),
         ]
-        if not config.delete_extra:
+        if not config.delete_extra and not config.manifest:
             rows.append(("retained", self.buckets["retained"], False))
         rows.append(("total", self.buckets["total"], True))
         if config.delete_extra:
@@ -251,6 +833,127 @@ class StatsAccumulator:
         return rows
 
 
+def prometheus_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_file_atomically(path: str, text: str) -> None:
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with open(fd, "w", encoding="utf-8") as fh:
+            fh.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        discard_temp_output(tmp_path)
+        raise
+
+
+class MetricsExporter:
+    def __init__(self, config: Config, stats: StatsAccumulator) -> None:
+        self.config = config
+        self.stats = stats
+        self.started = time.monotonic()
+        self.started_wall = time.time()
+        self.last_write = self.started
+
+    def refresh(self) -> None:
+        now = time.monotonic()
+        if now - self.last_write >= self.config.metrics_interval:
+            self.write("running")
+
+    def next_refresh(self) -> float:
+        return max(self.last_write + self.config.metrics_interval - time.monotonic(), 0.0)
+
+    def write(self, state: str) -> None:
+        self.last_write = time.monotonic()
+        snapshot = self.snapshot(state)
+        try:
+            if self.config.metrics_textfile:
+                write_file_atomically(self.config.metrics_textfile, self.render_prometheus(snapshot))
+            if self.config.metrics_json:
+                write_file_atomically(self.config.metrics_json, json.dumps(snapshot, indent=2) + "\n")
+        except OSError as exc:
+            die(f"cannot write metrics: {exc}")
+
+    def snapshot(self, state: str) -> dict:
+        self.stats.compute_total()
+        duration = time.monotonic() - self.started
+        categories = {}
+        for status in STAT_ORDER:
+            bucket = self.stats.buckets[status]
+            uncompressed = bucket.uncompressed if bucket.uncompressed_known else None
+            output_bytes = bucket.output_bytes if bucket.output_known else None
+            categories[status] = {
+                "files": bucket.files,
+                "uncompressed_bytes": uncompressed,
+                "input_bytes": bucket.input_bytes if bucket.input_known else None,
+                "output_bytes": output_bytes,
+                "ratio": output_bytes / uncompressed if uncompressed and output_bytes is not None else None,
+            }
+        stages = self.stats.stages.totals
+        processed = self.stats.buckets["converted"].input_bytes + self.stats.buckets["verified"].input_bytes
+        return {
+            "source": self.config.source_dir,
+            "target": self.config.target_dir,
+            "compressor": self.config.compressor,
+            "state": state,
+            "errors": 1 if state == "failed" else 0,
+            "started": self.started_wall,
+            "updated": time.time(),
+            "duration_seconds": duration,
+            "input_bytes_per_second": processed / duration if duration > 0 else 0.0,
+            "categories": categories,
+            "encodings": dict(sorted(self.stats.encodings.items())),
+            "stages": {
+                stage: {"count": int(stages[stage][0]), "wall_seconds": stages[stage][1], "cpu_seconds": stages[stage][2]}
+                for stage in STAGE_ORDER
+                if stage in stages
+            },
+        }
+
+    def render_prometheus(self, snapshot: dict) -> str:
+        target = f'target="{prometheus_label(snapshot["target"])}"'
+        lines: list[str] = []
+
+        def metric(name: str, kind: str, help_text: str, samples: list[tuple[str, Optional[float]]]) -> None:
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                return
+            lines.append(f"# HELP {METRICS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{METRICS_PREFIX}_{name}{{{target}{labels}}} {value:.17g}")
+
+        categories = snapshot["categories"]
+        for key, help_text in (
+            ("files", "Files per outcome category."),
+            ("uncompressed_bytes", "Uncompressed bytes per outcome category."),
+            ("input_bytes", "Source bytes per outcome category."),
+            ("output_bytes", "Target bytes per outcome category."),
+            ("ratio", "Target bytes over uncompressed bytes per outcome category."),
+        ):
+            name = "compression_ratio" if key == "ratio" else key
+            metric(name, "gauge", help_text, [(f',category="{status}"', entry[key]) for status, entry in categories.items()])
+        metric("encoding_files", "gauge", "Converted files per encoding.", [(f',encoding="{prometheus_label(encoding)}"', files) for encoding, files in snapshot["encodings"].items()])
+        stages = snapshot["stages"]
+        metric("stage_count", "gauge", "Work items timed per stage.", [(f',stage="{stage}"', entry["count"]) for stage, entry in stages.items()])
+        metric("stage_wall_seconds", "gauge", "Wall time per stage.", [(f',stage="{stage}"', entry["wall_seconds"]) for stage, entry in stages.items()])
+        metric("stage_cpu_seconds", "gauge", "CPU time per stage.", [(f',stage="{stage}"', entry["cpu_seconds"]) for stage, entry in stages.items()])
+        metric("duration_seconds", "gauge", "Run time so far.", [("", snapshot["duration_seconds"])])
+        metric("input_bytes_per_second", "gauge", "Converted and verified source bytes per second of run time.", [("", snapshot["input_bytes_per_second"])])
+        metric("errors", "gauge", "1 if the run failed.", [("", snapshot["errors"])])
+        metric("running", "gauge", "1 while the run is in progress.", [("", 1 if snapshot["state"] == "running" else 0)])
+        metric("start_timestamp_seconds", "gauge", "Unix time the run started.", [("", snapshot["started"])])
+        metric("last_update_timestamp_seconds", "gauge", "Unix time these metrics were written.", [("", snapshot["updated"])])
+        return "\n".join(lines) + "\n"
+
+
+def open_metrics_exporter(config: Config, stats: StatsAccumulator) -> Optional[MetricsExporter]:
+    if not config.metrics_textfile and not config.metrics_json:
+        return None
+    return MetricsExporter(config, stats)
+
+
 def status_label(status: str, config: Config, *, lowercase: bool = False) -> str:
     label = {
         "converted": "Would convert" if config.dry_run else "Converted",
@@ -275,14 +978,126 @@ Options:
   --compress-opts OPTS    Extra options passed to the target compressor
                           Example: --compress-opts "-19 -T0"
   --suffix SUFFIX         Override the target filename suffix
-  --hosts-file PATH       GNU parallel sshlogin file; when set, conversions run
-                          remotely through GNU parallel
+  --hosts-file PATH       sshlogin file with one [N/]host per line (":" is this
+                          machine); conversions run on one persistent worker
+                          per host, started over ssh
+  --remote-transport MODE With --hosts-file: shared (default) lets workers read
+                          and write the source and target paths directly;
+                          stream sends source bytes to the workers and writes
+                          their compressed output locally, so hosts need no
+                          shared filesystem
   --jobs N                Parallel job count; local runs default to the number
-                          of processors, remote runs use GNU parallel
+                          of processors, remote hosts use N from the hosts
+                          file, then this value, then their processor count
+  --scan-jobs N           Directories scanned concurrently while walking the
+                          source and target trees (default: 8)
+  --schedule MODE         Dispatch order: lex (default) or largest-first,
+                          which starts the biggest planned files first
+  --lookahead N           Planned files considered at once by largest-first
+                          scheduling (default: 1024)
+  --max-threads N         Cap on compressor threads running at once across
+                          local jobs (default: number of processors); remote
+                          workers budget against their own processors
+  --max-memory SIZE       Cap on estimated compressor memory across local
+                          jobs, e.g. 16G (default: 3/4 of physical memory);
+                          remote workers budget against their own memory
+  --in-flight-high SIZE   Stop dispatching once the source files handed to
+                          workers but not finished add up to SIZE
+                          (default: 256 MiB per job)
+  --in-flight-low SIZE    Resume dispatching once in-flight source bytes drop
+                          back to SIZE (default: half of --in-flight-high)
+  --trace FILE            Write a Chrome trace (open it in Perfetto or
+                          chrome://tracing) with a span per work item and
+                          stage on each worker thread, plus the main
+                          thread's dispatch waits and outcome handling
+  --trace-jsonl FILE      Write the same events as JSON lines
+  --metrics-textfile FILE Write run metrics (per-category files and bytes,
+                          compression ratio, stage times, duration, errors)
+                          in Prometheus text format, e.g. into the
+                          node_exporter textfile collector directory
+  --metrics-json FILE     Write the same metrics as a JSON document
+  --metrics-interval SEC  Rewrite the metrics files at most this often while
+                          the run is in progress (default: 15)
   --delete                Delete files in the target tree that are not
                           produced by this run
   --compare-bytes         Before reusing a target, compare the uncompressed
                           data streams byte-for-byte
+  --manifest              Keep a run manifest in the target root; unchanged
+                          files are verified from it without scanning the
+                          target tree (the target is still scanned with
+                          --delete); converted files also record a hash of
+                          their uncompressed data, which --compare-bytes
+                          checks instead of decompressing the target
+  --scrub                 With --manifest and --compare-bytes, check each
+                          target against its recorded hash instead of
+                          re-reading the source
+  --resume                Continue an interrupted run: files recorded in the
+                          run journal (.mirror_journal.jsonl in the target
+                          root) are skipped and their totals restored, and
+                          leftover temporary outputs are removed; the journal
+                          is deleted once a run completes
+  --prescan               Walk the source tree in the background to total
+                          its files and bytes, so the progress line can show
+                          what is queued and an ETA; with --manifest and no
+                          --prescan, the previous run's totals are used
+  --watch                 After the initial pass, keep running and mirror
+                          source changes as they happen: inotify reports the
+                          changed paths (the source tree is polled instead
+                          where inotify is unavailable), and only those
+                          files and directories are planned and converted;
+                          removed sources are removed from the target with
+                          --delete. Stop with Ctrl-C or SIGTERM
+  --watch-debounce SEC    Wait until a changed path has been quiet this long
+                          before mirroring it (default: 2; at least one
+                          scan interval when polling)
+  --watch-interval SEC    Seconds between scans when polling (default: 10)
+  --in-process            Run gzip, bzip2, xz and lzma (plus zstd and brotli
+                          when their Python bindings are installed) inside
+                          this process instead of spawning codec commands;
+                          compressor options other than a single level flag
+                          fall back to the external command
+  --passthrough MODE      For sources already in the target format: off
+                          (default) recompresses them, copy reuses the
+                          compressed bytes (reflink when the filesystem
+                          supports it), test also checks that the source
+                          decompresses cleanly before copying it
+  --target-throughput N   Pick a compression level per file so the run keeps
+                          up with N MB/s of source data overall; large files
+                          trial-compress a sample at each candidate level
+                          and use the highest level fast enough for the
+                          remaining work, smaller files reuse the latest pick
+  --adaptive-levels LIST  Candidate levels for --target-throughput, e.g.
+                          1,3,6,9 (default depends on the compressor)
+  --block-size SIZE       Split files larger than SIZE into blocks that are
+                          compressed in parallel (each file on its share of
+                          --max-threads, i.e. --max-threads / --jobs, which
+                          admission charges against the thread and memory
+                          budgets) and written as concatenated gzip members,
+                          bzip2, xz or lzip streams, or zstd or lz4 frames,
+                          which the standard decompressors read as one file
+  --decode-threads N      Decode large sources made of independent pieces
+                          (BGZF gzip blocks, multi-frame zstd, multi-stream
+                          xz) on N threads while keeping output in order;
+                          other large xz sources use xz -T N (default: 1;
+                          capped at --max-threads / --jobs per file)
+  --read-limit MBPS       Cap on source and target file reads, in MB/s
+  --write-limit MBPS      Cap on target file writes, in MB/s
+  --iops-limit N          Cap on file reads and writes per second (each up
+                          to 1 MiB); limits apply per host, and while one is
+                          set SIGUSR1 also stalls transfers in progress
+  --nice N                Niceness increment for the run and the codec
+                          processes it starts
+  --ionice CLASS[:LEVEL]  I/O scheduling class for the run and the codec
+                          processes it starts: idle, best-effort[:0-7] or
+                          realtime[:0-7]
+  --incompressible MODE   off (default) or fast, which compresses the first
+                          2 MiB of each file with zlib level 1 and stores
+                          files that barely shrink at the target
+                          compressor's fastest level
+  --incompressible-ratio R
+                          Compressed-to-original sample ratio at or above
+                          which a file counts as incompressible
+                          (default: 0.95)
   --verbose, -v           Show planning, verification, and cleanup details
   --dry-run               Show planned work without writing changes
   --quiet                 Reduce progress output
@@ -305,6 +1120,23 @@ def human_size(value: Optional[int], known: bool = True) -> str:
     return f"{size:.1f} {units[index]}"
 
 
+def format_seconds(seconds: float) -> str:
+    return f"{seconds:.2f} s"
+
+
+def format_rate(size: float, seconds: float) -> str:
+    return f"{size / seconds / MB:.1f} MB/s" if seconds > 0 else "-"
+
+
+def format_duration(seconds: float) -> str:
+    whole = int(seconds)
+    if whole >= 3600:
+        return f"{whole // 3600}h{whole % 3600 // 60:02d}m"
+    if whole >= 60:
+        return f"{whole // 60}m{whole % 60:02d}s"
+    return f"{whole}s"
+
+
 def log(config: Config, message: str) -> None:
     if not config.quiet:
         print(message)
@@ -328,14 +1160,47 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
     parser.add_argument("--compress-opts", default="")
     parser.add_argument("--suffix", default="")
     parser.add_argument("--hosts-file", default="")
+    parser.add_argument("--remote-transport", default="")
     parser.add_argument("--jobs", type=int)
+    parser.add_argument("--scan-jobs", type=int)
+    parser.add_argument("--schedule", default="")
+    parser.add_argument("--lookahead", type=int)
+    parser.add_argument("--max-threads", type=int)
+    parser.add_argument("--max-memory", default="")
     parser.add_argument("--delete", action="store_true")
     parser.add_argument("--compare-bytes", action="store_true")
+    parser.add_argument("--manifest", action="store_true")
+    parser.add_argument("--scrub", action="store_true")
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--prescan", action="store_true")
+    parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--watch-debounce", default="")
+    parser.add_argument("--watch-interval", default="")
+    parser.add_argument("--in-process", action="store_true")
+    parser.add_argument("--passthrough", default="")
+    parser.add_argument("--target-throughput", default="")
+    parser.add_argument("--adaptive-levels", default="")
+    parser.add_argument("--incompressible", default="")
+    parser.add_argument("--incompressible-ratio", default="")
+    parser.add_argument("--block-size", default="")
+    parser.add_argument("--decode-threads", type=int)
+    parser.add_argument("--read-limit", default="")
+    parser.add_argument("--write-limit", default="")
+    parser.add_argument("--iops-limit", default="")
+    parser.add_argument("--nice", type=int)
+    parser.add_argument("--ionice", default="")
+    parser.add_argument("--in-flight-high", default="")
+    parser.add_argument("--in-flight-low", default="")
+    parser.add_argument("--trace", default="")
+    parser.add_argument("--trace-jsonl", default="")
+    parser.add_argument("--metrics-textfile", default="")
+    parser.add_argument("--metrics-json", default="")
+    parser.add_argument("--metrics-interval", default="")
     parser.add_argument("--verbose", "-v", action="store_true")
     parser.add_argument("--dry-run", action="store_true")
     parser.add_argument("--quiet", action="store_true")
     parser.add_argument("--list-compressors", action="store_true")
-    parser.add_argument("--internal-convert")
+    parser.add_argument("--worker", action="store_true")
     parser.add_argument("-h", "--help", action="store_true")
     ns = parser.parse_args(argv)
     if ns.help:
@@ -348,6 +1213,20 @@ def default_local_jobs() -> int:
     return os.cpu_count() or 1
 
 
+def default_memory_budget() -> Optional[int]:
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") * 3 // 4
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def parse_size(value: str) -> int:
+    match = SIZE_RE.fullmatch(value.strip())
+    if match is None:
+        die(f"invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
 def env_flag(name: str) -> bool:
     return os.environ.get(name, "false") == "true"
 
@@ -356,11 +1235,11 @@ def cli_or_env_str(cli_value: Optional[str], env_name: str, default: str = "") -
     return cli_value if cli_value not in (None, "") else os.environ.get(env_name, default)
 
 
-def cli_or_env_jobs(cli_value: Optional[int]) -> Optional[int]:
+def cli_or_env_jobs(cli_value: Optional[int], env_name: str = "JOBS") -> Optional[int]:
     if cli_value is not None:
         return cli_value
-    if os.environ.get("JOBS"):
-        return int(os.environ["JOBS"])
+    if os.environ.get(env_name):
+        return int(os.environ[env_name])
     return None
 
 
@@ -372,9 +1251,42 @@ def load_config_values(ns: argparse.Namespace) -> ConfigValues:
         compress_opts=shlex.split(cli_or_env_str(ns.compress_opts, "COMPRESS_OPTS")),
         target_suffix=cli_or_env_str(ns.suffix, "TARGET_SUFFIX"),
         hosts_file=cli_or_env_str(ns.hosts_file, "HOSTS_FILE"),
+        remote_transport=cli_or_env_str(ns.remote_transport, "REMOTE_TRANSPORT", "shared"),
         jobs=cli_or_env_jobs(ns.jobs),
+        scan_jobs=cli_or_env_jobs(ns.scan_jobs, "SCAN_JOBS"),
+        schedule=cli_or_env_str(ns.schedule, "SCHEDULE", "lex"),
+        lookahead=cli_or_env_jobs(ns.lookahead, "LOOKAHEAD"),
+        max_threads=cli_or_env_jobs(ns.max_threads, "MAX_THREADS"),
+        max_memory=cli_or_env_str(ns.max_memory, "MAX_MEMORY"),
         delete_extra=ns.delete or env_flag("DELETE_EXTRA"),
         compare_bytes=ns.compare_bytes or env_flag("COMPARE_BYTES"),
+        manifest=ns.manifest or env_flag("MANIFEST"),
+        scrub=ns.scrub or env_flag("SCRUB"),
+        resume=ns.resume or env_flag("RESUME"),
+        prescan=ns.prescan or env_flag("PRESCAN"),
+        watch=ns.watch or env_flag("WATCH"),
+        in_process=ns.in_process or env_flag("IN_PROCESS"),
+        passthrough=cli_or_env_str(ns.passthrough, "PASSTHROUGH", "off"),
+        target_throughput=cli_or_env_str(ns.target_throughput, "TARGET_THROUGHPUT"),
+        adaptive_levels=cli_or_env_str(ns.adaptive_levels, "ADAPTIVE_LEVELS"),
+        incompressible=cli_or_env_str(ns.incompressible, "INCOMPRESSIBLE", "off"),
+        incompressible_ratio=cli_or_env_str(ns.incompressible_ratio, "INCOMPRESSIBLE_RATIO"),
+        block_size=cli_or_env_str(ns.block_size, "BLOCK_SIZE"),
+        decode_threads=cli_or_env_jobs(ns.decode_threads, "DECODE_THREADS"),
+        read_limit=cli_or_env_str(ns.read_limit, "READ_LIMIT"),
+        write_limit=cli_or_env_str(ns.write_limit, "WRITE_LIMIT"),
+        iops_limit=cli_or_env_str(ns.iops_limit, "IOPS_LIMIT"),
+        nice=cli_or_env_jobs(ns.nice, "NICE"),
+        ionice=cli_or_env_str(ns.ionice, "IONICE"),
+        in_flight_high=cli_or_env_str(ns.in_flight_high, "IN_FLIGHT_HIGH"),
+        in_flight_low=cli_or_env_str(ns.in_flight_low, "IN_FLIGHT_LOW"),
+        trace=cli_or_env_str(ns.trace, "TRACE"),
+        trace_jsonl=cli_or_env_str(ns.trace_jsonl, "TRACE_JSONL"),
+        metrics_textfile=cli_or_env_str(ns.metrics_textfile, "METRICS_TEXTFILE"),
+        metrics_json=cli_or_env_str(ns.metrics_json, "METRICS_JSON"),
+        metrics_interval=cli_or_env_str(ns.metrics_interval, "METRICS_INTERVAL"),
+        watch_debounce=cli_or_env_str(ns.watch_debounce, "WATCH_DEBOUNCE"),
+        watch_interval=cli_or_env_str(ns.watch_interval, "WATCH_INTERVAL"),
         dry_run=ns.dry_run or env_flag("DRY_RUN"),
         verbose=ns.verbose or env_flag("VERBOSE"),
         quiet=ns.quiet or env_flag("QUIET"),
@@ -390,7 +1302,63 @@ def codec_binary(codec_name: str, purpose: str) -> str:
     return codec_obj.compressor_binary if purpose == "compress" else codec_obj.decompressor_binary
 
 
-def require_available_codec(codec_name: str, purpose: str) -> None:
+def in_process_level(codec_name: str, opts: list[str]) -> Optional[int]:
+    engine = get_codec(codec_name).in_process
+    if engine is None:
+        return None
+    if not opts:
+        return engine.default_level
+    match = LEVEL_OPT_RE.fullmatch(opts[0]) if len(opts) == 1 else None
+    if match is None or int(match.group(1)) not in engine.levels:
+        return None
+    return int(match.group(1))
+
+
+def in_process_compressor(codec_name: str, opts: list[str], enabled: bool) -> Optional[StreamCompressor]:
+    level = in_process_level(codec_name, opts) if enabled else None
+    if level is None:
+        return None
+    engine = get_codec(codec_name).in_process
+    assert engine is not None
+    return engine.compressor(level)
+
+
+def in_process_reader(codec_name: str, enabled: bool) -> Optional[Callable[[BinaryIO], BinaryIO]]:
+    engine = get_codec(codec_name).in_process if enabled else None
+    return engine.reader if engine is not None else None
+
+
+def estimate_codec_resources(codec_name: str, opts: list[str]) -> ResourceCost:
+    resources = get_codec(codec_name).resources
+    level = resources.default_level
+    threads = 1
+    extra_memory = 0
+    for index, opt in enumerate(opts):
+        if LEVEL_OPT_RE.fullmatch(opt):
+            level = int(opt[1:])
+        elif THREADS_OPT_RE.fullmatch(opt):
+            threads = int(THREADS_OPT_RE.fullmatch(opt).group(1))
+        elif opt in ("-T", "--threads") and index + 1 < len(opts) and opts[index + 1].isdigit():
+            threads = int(opts[index + 1])
+        elif LONG_OPT_RE.fullmatch(opt):
+            window_log = LONG_OPT_RE.fullmatch(opt).group(1)
+            extra_memory = 2 << int(window_log or 27)
+    if threads == 0:
+        threads = default_local_jobs()
+    if not resources.threaded:
+        threads = 1
+    return ResourceCost(threads=threads, memory=(resources.memory_for_level(level) + extra_memory) * threads)
+
+
+def conversion_cost_opts(config: Config) -> list[str]:
+    if not config.adaptive_levels:
+        return config.compress_opts
+    return [f"-{config.adaptive_levels[-1]}", *(opt for opt in config.compress_opts if not LEVEL_OPT_RE.fullmatch(opt))]
+
+
+def require_available_codec(codec_name: str, purpose: str, in_process: bool = False) -> None:
+    if in_process:
+        return
     binary = codec_binary(codec_name, purpose)
     if binary != "cat" and shutil.which(binary) is None:
         die(f"required {purpose}or for '{codec_name}' is not available")
@@ -409,6 +1377,66 @@ def validate_tree_separation(source_dir: str, target_dir: str) -> None:
         die("source and target directories must not overlap")
 
 
+def validate_adaptive_levels(values: ConfigValues) -> tuple[Optional[float], list[int]]:
+    if not values.target_throughput:
+        return None, []
+    try:
+        target_throughput = float(values.target_throughput)
+    except ValueError:
+        die(f"invalid --target-throughput: {values.target_throughput}")
+    if target_throughput <= 0:
+        die("--target-throughput must be positive")
+    if values.compressor not in ADAPTIVE_LEVELS:
+        die(f"--target-throughput is not supported for compressor '{values.compressor}'")
+    if not values.adaptive_levels:
+        return target_throughput, list(ADAPTIVE_LEVELS[values.compressor])
+    try:
+        levels = sorted({int(level) for level in values.adaptive_levels.split(",")})
+    except ValueError:
+        die(f"invalid --adaptive-levels: {values.adaptive_levels}")
+    return target_throughput, levels
+
+
+def validate_incompressible(values: ConfigValues) -> float:
+    if values.incompressible not in INCOMPRESSIBLE_MODES:
+        die(f"unknown incompressible mode: {values.incompressible}")
+    if values.incompressible != "off" and values.compressor not in ADAPTIVE_LEVELS:
+        die(f"--incompressible is not supported for compressor '{values.compressor}'")
+    if not values.incompressible_ratio:
+        return DEFAULT_INCOMPRESSIBLE_RATIO
+    try:
+        ratio = float(values.incompressible_ratio)
+    except ValueError:
+        die(f"invalid --incompressible-ratio: {values.incompressible_ratio}")
+    if not 0 < ratio <= 1:
+        die("--incompressible-ratio must be between 0 and 1")
+    return ratio
+
+
+def validate_rate(value: str, flag: str) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        rate = float(value)
+    except ValueError:
+        die(f"invalid {flag}: {value}")
+    if rate <= 0:
+        die(f"{flag} must be positive")
+    return rate
+
+
+def validate_ionice(value: str) -> None:
+    if not value:
+        return
+    name, separator, level = value.partition(":")
+    if name not in IONICE_CLASSES:
+        die(f"unknown I/O scheduling class: {name}")
+    if separator and (name == "idle" or not level.isdigit() or int(level) > 7):
+        die(f"invalid --ionice level: {value}")
+    if shutil.which("ionice") is None:
+        die("--ionice requires the ionice command")
+
+
 def validate_config(values: ConfigValues) -> Config:
     if not values.source_dir or not values.target_dir:
         print(usage_text(), end="", file=sys.stderr)
@@ -420,7 +1448,11 @@ def validate_config(values: ConfigValues) -> Config:
     if values.compressor not in CODECS:
         die(f"unknown compressor: {values.compressor}")
 
-    require_available_codec(values.compressor, "compress")
+    require_available_codec(
+        values.compressor,
+        "compress",
+        values.in_process and in_process_level(values.compressor, values.compress_opts) is not None,
+    )
     source_dir = os.path.realpath(values.source_dir)
     os.makedirs(values.target_dir, exist_ok=True)
     target_dir = os.path.realpath(values.target_dir)
@@ -429,6 +1461,42 @@ def validate_config(values: ConfigValues) -> Config:
     target_suffix = values.target_suffix or get_codec(values.compressor).suffix
     if values.hosts_file and not os.path.isfile(values.hosts_file):
         die(f"hosts file not found: {values.hosts_file}")
+    scan_jobs = DEFAULT_SCAN_JOBS if values.scan_jobs is None else values.scan_jobs
+    if scan_jobs < 1:
+        die("--scan-jobs must be at least 1")
+    if values.schedule not in SCHEDULES:
+        die(f"unknown schedule: {values.schedule}")
+    lookahead = DEFAULT_LOOKAHEAD if values.lookahead is None else values.lookahead
+    if lookahead < 1:
+        die("--lookahead must be at least 1")
+    if values.remote_transport not in REMOTE_TRANSPORTS:
+        die(f"unknown remote transport: {values.remote_transport}")
+    if values.passthrough not in PASSTHROUGH_MODES:
+        die(f"unknown passthrough mode: {values.passthrough}")
+    max_threads = default_local_jobs() if values.max_threads is None else values.max_threads
+    if max_threads < 1:
+        die("--max-threads must be at least 1")
+    max_memory = parse_size(values.max_memory) if values.max_memory else default_memory_budget()
+    target_throughput, adaptive_levels = validate_adaptive_levels(values)
+    incompressible_ratio = validate_incompressible(values)
+    block_size = parse_size(values.block_size) if values.block_size else None
+    if block_size is not None and block_size < MIN_BLOCK_SIZE:
+        die(f"--block-size must be at least {human_size(MIN_BLOCK_SIZE)}")
+    if block_size is not None and values.compressor not in CONCATENATED_CODECS:
+        die(f"--block-size is not supported for compressor '{values.compressor}'")
+    decode_threads = 1 if values.decode_threads is None else values.decode_threads
+    if decode_threads < 1:
+        die("--decode-threads must be at least 1")
+    validate_ionice(values.ionice)
+    in_flight_high = parse_size(values.in_flight_high) if values.in_flight_high else None
+    in_flight_low = parse_size(values.in_flight_low) if values.in_flight_low else None
+    if in_flight_high is not None and in_flight_high < 1:
+        die("--in-flight-high must be positive")
+    if in_flight_high is not None and in_flight_low is not None and in_flight_low > in_flight_high:
+        die("--in-flight-low must not exceed --in-flight-high")
+    metrics_interval = validate_rate(values.metrics_interval, "--metrics-interval")
+    watch_debounce = validate_rate(values.watch_debounce, "--watch-debounce")
+    watch_interval = validate_rate(values.watch_interval, "--watch-interval")
 
     return Config(
         source_dir=source_dir,
@@ -437,9 +1505,42 @@ def validate_config(values: ConfigValues) -> Config:
         compress_opts=values.compress_opts,
         target_suffix=target_suffix,
         hosts_file=values.hosts_file,
+        remote_transport=values.remote_transport,
         jobs=values.jobs,
+        scan_jobs=scan_jobs,
+        schedule=values.schedule,
+        lookahead=lookahead,
+        max_threads=max_threads,
+        max_memory=max_memory,
         delete_extra=values.delete_extra,
         compare_bytes=values.compare_bytes,
+        manifest=values.manifest,
+        scrub=values.scrub,
+        resume=values.resume,
+        prescan=values.prescan,
+        watch=values.watch,
+        in_process=values.in_process,
+        passthrough=values.passthrough,
+        target_throughput=target_throughput,
+        adaptive_levels=adaptive_levels,
+        incompressible=values.incompressible,
+        incompressible_ratio=incompressible_ratio,
+        block_size=block_size,
+        decode_threads=decode_threads,
+        read_limit=validate_rate(values.read_limit, "--read-limit"),
+        write_limit=validate_rate(values.write_limit, "--write-limit"),
+        iops_limit=validate_rate(values.iops_limit, "--iops-limit"),
+        nice=values.nice,
+        ionice=values.ionice,
+        in_flight_high=in_flight_high,
+        in_flight_low=in_flight_low,
+        trace=values.trace,
+        trace_jsonl=values.trace_jsonl,
+        metrics_textfile=values.metrics_textfile,
+        metrics_json=values.metrics_json,
+        metrics_interval=DEFAULT_METRICS_INTERVAL if metrics_interval is None else metrics_interval,
+        watch_debounce=DEFAULT_WATCH_DEBOUNCE if watch_debounce is None else watch_debounce,
+        watch_interval=DEFAULT_WATCH_INTERVAL if watch_interval is None else watch_interval,
         dry_run=values.dry_run,
         verbose=values.verbose,
         quiet=values.quiet,
@@ -477,7 +1578,7 @@ def target_rel_for(source_rel: str, target_suffix: str) -> str:
 
 def build_file_task(config: Config, source_path: str, source_rel: str, source_stat: os.stat_result) -> FileTask:
     input_format = detect_input_format(source_rel)
-    require_available_codec(input_format, "decompress")
+    require_available_codec(input_format, "decompress", in_process_reader(input_format, config.in_process) is not None)
     target_rel = target_rel_for(source_rel, config.target_suffix)
     return FileTask(
         source_path=source_path,
@@ -490,16 +1591,206 @@ def build_file_task(config: Config, source_path: str, source_rel: str, source_st
     )
 
 
-def build_internal_task(config: Config, source_file: str) -> FileTask:
-    source_rel = os.path.relpath(source_file, config.source_dir)
-    return build_file_task(config, source_file, source_rel, os.stat(source_file, follow_symlinks=False))
+class TokenBucket:
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = rate * IO_BURST_SECONDS
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount: float) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate) - amount
+            self.stamp = now
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MeteredReader(io.RawIOBase):
+    def __init__(self, fh: BinaryIO, charge: Callable[[int], None]) -> None:
+        self.fh = fh
+        self.charge = charge
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray | memoryview) -> int:
+        count = self.fh.readinto(buffer)
+        if count:
+            self.charge(count)
+        return count
+
+    def close(self) -> None:
+        self.fh.close()
+        super().close()
+
+
+class MeteredWriter(io.RawIOBase):
+    def __init__(self, fh: BinaryIO, charge: Callable[[int], None]) -> None:
+        self.fh = fh
+        self.charge = charge
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes | bytearray | memoryview) -> int:
+        self.charge(len(data))
+        return self.fh.write(data)
+
+    def close(self) -> None:
+        self.fh.close()
+        super().close()
+
+
+class IoGovernor:
+    def __init__(self) -> None:
+        self.read_bucket: Optional[TokenBucket] = None
+        self.write_bucket: Optional[TokenBucket] = None
+        self.op_bucket: Optional[TokenBucket] = None
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+    def configure(self, config: Config, share: int = 1) -> None:
+        self.read_bucket = TokenBucket(config.read_limit * MB / share) if config.read_limit else None
+        self.write_bucket = TokenBucket(config.write_limit * MB / share) if config.write_limit else None
+        self.op_bucket = TokenBucket(config.iops_limit / share) if config.iops_limit else None
+
+    @property
+    def meters_reads(self) -> bool:
+        return self.read_bucket is not None or self.op_bucket is not None
+
+    @property
+    def meters_writes(self) -> bool:
+        return self.write_bucket is not None or self.op_bucket is not None
+
+    def charge_read(self, size: int) -> None:
+        self._charge(self.read_bucket, size)
+
+    def charge_write(self, size: int) -> None:
+        self._charge(self.write_bucket, size)
+
+    def _charge(self, bucket: Optional[TokenBucket], size: int) -> None:
+        self.resumed.wait()
+        if self.op_bucket is not None:
+            self.op_bucket.take(1)
+        if bucket is not None:
+            bucket.take(size)
+
+    def reader(self, fh: BinaryIO) -> BinaryIO:
+        if not self.meters_reads:
+            return fh
+        return io.BufferedReader(MeteredReader(fh, self.charge_read), CHUNK_SIZE)
+
+    def writer(self, fh: BinaryIO) -> BinaryIO:
+        if not self.meters_writes:
+            return fh
+        return io.BufferedWriter(MeteredWriter(fh, self.charge_write), CHUNK_SIZE)
+
+    def pause(self, *_: object) -> None:
+        self.resumed.clear()
+
+    def resume(self, *_: object) -> None:
+        self.resumed.set()
+
+
+IO_GOVERNOR = IoGovernor()
+
+
+def configure_io_governor(config: Config, share: int = 1) -> None:
+    IO_GOVERNOR.configure(config, share)
+
+
+def apply_process_priority(config: Config) -> None:
+    if config.nice:
+        try:
+            os.nice(config.nice)
+        except OSError as exc:
+            die(f"cannot apply --nice {config.nice}: {exc.strerror}")
+    if config.ionice:
+        name, _, level = config.ionice.partition(":")
+        command = ["ionice", "-c", str(IONICE_CLASSES[name]), *(["-n", level] if level else []), "-p", str(os.getpid())]
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            die(f"cannot apply --ionice {config.ionice}: {result.stderr.strip()}")
+
+
+def install_pause_handlers() -> None:
+    signal.signal(signal.SIGUSR1, IO_GOVERNOR.pause)
+    signal.signal(signal.SIGUSR2, IO_GOVERNOR.resume)
+
+
+def file_descriptor(fh: BinaryIO) -> Optional[int]:
+    try:
+        return fh.fileno()
+    except io.UnsupportedOperation:
+        return None
+
+
+def drain_process_output(proc: subprocess.Popen[bytes], out_fh: BinaryIO) -> None:
+    assert proc.stdout is not None
+    try:
+        with proc.stdout:
+            shutil.copyfileobj(proc.stdout, out_fh, CHUNK_SIZE)
+    except BaseException:
+        proc.kill()
+        raise
+
+
+def feed_process_input(source: BinaryIO, sink: BinaryIO, handle: Optional[StreamHandle] = None) -> None:
+    try:
+        with source, sink:
+            while True:
+                try:
+                    chunk = source.read(CHUNK_SIZE)
+                except (OSError, ValueError) as exc:
+                    if handle is not None:
+                        handle.feed_error = exc
+                    return
+                if not chunk:
+                    return
+                sink.write(chunk)
+    except (OSError, ValueError):
+        pass
+
+
+class PrefixedReader(io.RawIOBase):
+    def __init__(self, prefix: bytes, stream: BinaryIO) -> None:
+        self.prefix = memoryview(prefix)
+        self.stream = stream
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray | memoryview) -> int:
+        if self.prefix:
+            count = min(len(buffer), len(self.prefix))
+            buffer[:count] = self.prefix[:count]
+            self.prefix = self.prefix[count:]
+            return count
+        return self.stream.readinto(buffer)
+
+    def close(self) -> None:
+        self.stream.close()
+        super().close()
 
 
 class StreamHandle:
-    def __init__(self, stream: BinaryIO, processes: list[subprocess.Popen[bytes]], owned_files: list[BinaryIO]):
+    def __init__(
+        self,
+        stream: BinaryIO,
+        processes: list[subprocess.Popen[bytes]],
+        owned_files: list[BinaryIO],
+        raw_fd: Optional[int] = None,
+    ):
         self.stream = stream
         self.processes = processes
         self.owned_files = owned_files
+        self.raw_fd = raw_fd
+        self.feeder: Optional[threading.Thread] = None
+        self.feed_error: Optional[BaseException] = None
 
     def close(self) -> None:
         stream_error: Optional[BaseException] = None
@@ -512,147 +1803,811 @@ class StreamHandle:
                 fh.close()
             except Exception:
                 pass
-        for proc in self.processes:
-            ret = proc.wait()
+        returncodes = [(wait_process(proc, "decompress"), proc.args) for proc in self.processes]
+        if self.feeder is not None:
+            self.feeder.join()
+        if stream_error is None:
+            stream_error = self.feed_error
+        for ret, args in returncodes:
             if ret != 0 and stream_error is None:
-                stream_error = subprocess.CalledProcessError(ret, proc.args)
+                stream_error = subprocess.CalledProcessError(ret, args)
         if stream_error is not None:
             raise stream_error
 
+    def peek_prefix(self, size: int) -> bytes:
+        buffer = bytearray(size)
+        prefix = bytes(read_chunk_into(self.stream, buffer, memoryview(buffer)))
+        self.stream = PrefixedReader(prefix, self.stream)
+        self.raw_fd = None
+        return prefix
+
+    def abort(self) -> None:
+        for proc in self.processes:
+            if proc.poll() is None:
+                proc.kill()
+        for fh in [self.stream, *self.owned_files]:
+            try:
+                fh.close()
+            except Exception:
+                pass
+        for proc in self.processes:
+            wait_process(proc, "decompress")
+        if self.feeder is not None:
+            self.feeder.join()
+
+
+def wait_process(proc: subprocess.Popen[bytes], stage: str) -> int:
+    if proc.returncode is None:
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        STAGE_CLOCK.record_cpu(stage, usage.ru_utime + usage.ru_stime)
+    return proc.returncode
+
+
+def run_codec_process(command: list[str], data: bytes | memoryview, stage: str) -> bytes:
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    assert proc.stdin is not None and proc.stdout is not None
+    feeder = threading.Thread(target=feed_process_input, args=(io.BytesIO(data), proc.stdin))
+    feeder.start()
+    with proc.stdout:
+        output = proc.stdout.read()
+    feeder.join()
+    ret = wait_process(proc, stage)
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, proc.args)
+    return output
+
+
+def enlarge_pipe(fd: int) -> None:
+    if not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+    except OSError:
+        pass
+
 
-def open_decompressed_stream(path: str, codec_name: str) -> StreamHandle:
+def open_decompressed_stream(path: str, codec_name: str, in_process: bool = False, threads: int = 1) -> StreamHandle:
     if codec_name == "none":
         fh = open(path, "rb")
-        return StreamHandle(fh, [], [fh])
+        if IO_GOVERNOR.meters_reads:
+            return StreamHandle(IO_GOVERNOR.reader(fh), [], [fh])
+        return StreamHandle(fh, [], [fh], raw_fd=fh.fileno())
+    if threads > 1:
+        handle = open_parallel_decoded_stream(path, codec_name, in_process, threads)
+        if handle is not None:
+            return handle
+    reader = in_process_reader(codec_name, in_process)
+    if reader is not None:
+        fh = open(path, "rb")
+        try:
+            return StreamHandle(reader(IO_GOVERNOR.reader(fh)), [], [fh])
+        except Exception:
+            fh.close()
+            raise
+    if IO_GOVERNOR.meters_reads:
+        return open_metered_decompressor(path, codec_name)
     proc = subprocess.Popen(get_codec(codec_name).decompress_command(path), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     assert proc.stdout is not None
-    return StreamHandle(proc.stdout, [proc], [])
+    enlarge_pipe(proc.stdout.fileno())
+    return StreamHandle(proc.stdout, [proc], [], raw_fd=proc.stdout.fileno())
+
+
+def open_metered_decompressor(path: str, codec_name: str) -> StreamHandle:
+    fh = open(path, "rb")
+    try:
+        proc = subprocess.Popen(
+            get_codec(codec_name).decompress_command("/dev/stdin"),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+    except Exception:
+        fh.close()
+        raise
+    assert proc.stdin is not None and proc.stdout is not None
+    enlarge_pipe(proc.stdout.fileno())
+    handle = StreamHandle(proc.stdout, [proc], [], raw_fd=proc.stdout.fileno())
+    handle.feeder = threading.Thread(target=feed_process_input, args=(IO_GOVERNOR.reader(fh), proc.stdin, handle), daemon=True)
+    handle.feeder.start()
+    return handle
+
+
+def open_decompressed_pipe(fh: BinaryIO, codec_name: str, in_process: bool = False) -> StreamHandle:
+    if codec_name == "none":
+        return StreamHandle(fh, [], [fh], raw_fd=fh.fileno())
+    reader = in_process_reader(codec_name, in_process)
+    if reader is not None:
+        return StreamHandle(reader(fh), [], [fh])
+    try:
+        proc = subprocess.Popen(get_codec(codec_name).decompress_command("/dev/stdin"), stdin=fh, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    finally:
+        fh.close()
+    assert proc.stdout is not None
+    enlarge_pipe(proc.stdout.fileno())
+    return StreamHandle(proc.stdout, [proc], [], raw_fd=proc.stdout.fileno())
 
 
 def read_chunk_into(stream: BinaryIO, buffer: bytearray, view: memoryview) -> memoryview:
-    count = stream.readinto(buffer)
-    if count is None:
-        count = 0
+    count = 0
+    while count < len(buffer):
+        read = stream.readinto(view[count:])
+        if not read:
+            break
+        count += read
     return view[:count]
 
 
-def copy_stream(reader: StreamHandle, writer: BinaryIO) -> int:
+def new_content_hasher() -> ContentHasher:
+    return hashlib.blake2b(digest_size=CONTENT_HASH_DIGEST_SIZE)
+
+
+def is_pipe(fd: int) -> bool:
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+
+def kernel_copy_loop(copy_chunk: Callable[[], int]) -> Optional[int]:
+    total = 0
+    while True:
+        try:
+            count = copy_chunk()
+        except OSError as exc:
+            if total == 0 and exc.errno in KERNEL_COPY_FALLBACK_ERRORS:
+                return None
+            raise
+        if count == 0:
+            return total
+        total += count
+
+
+def kernel_copy(in_fd: int, out_fd: int) -> Optional[int]:
+    if is_pipe(in_fd) or is_pipe(out_fd):
+        if not hasattr(os, "splice"):
+            return None
+        return kernel_copy_loop(lambda: os.splice(in_fd, out_fd, CHUNK_SIZE))
+    if hasattr(os, "copy_file_range"):
+        copied = kernel_copy_loop(lambda: os.copy_file_range(in_fd, out_fd, CHUNK_SIZE))
+        if copied is not None:
+            return copied
+    if hasattr(os, "sendfile"):
+        return kernel_copy_loop(lambda: os.sendfile(out_fd, in_fd, None, CHUNK_SIZE))
+    return None
+
+
+def copy_stream(reader: StreamHandle, writer: BinaryIO, hasher: Optional[ContentHasher] = None) -> int:
+    out_fd = file_descriptor(writer) if hasher is None and reader.raw_fd is not None else None
+    if out_fd is not None and reader.raw_fd is not None:
+        writer.flush()
+        with STAGE_CLOCK.measure("compress"):
+            copied = kernel_copy(reader.raw_fd, out_fd)
+        if copied is not None:
+            return copied
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    total = 0
+    while True:
+        with STAGE_CLOCK.measure("decompress"):
+            chunk = read_chunk_into(reader.stream, buffer, view)
+        if not chunk:
+            return total
+        with STAGE_CLOCK.measure("compress"):
+            writer.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+        total += len(chunk)
+
+
+def compress_stream(reader: StreamHandle, writer: BinaryIO, compressor: StreamCompressor, hasher: Optional[ContentHasher] = None) -> int:
     buffer = bytearray(CHUNK_SIZE)
     view = memoryview(buffer)
     total = 0
     while True:
-        chunk = read_chunk_into(reader.stream, buffer, view)
+        with STAGE_CLOCK.measure("decompress"):
+            chunk = read_chunk_into(reader.stream, buffer, view)
+        with STAGE_CLOCK.measure("compress"):
+            writer.write(compressor.compress(chunk) if chunk else compressor.flush())
         if not chunk:
             return total
-        writer.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
         total += len(chunk)
 
 
-def compare_streams(left_handle: StreamHandle, right_handle: StreamHandle) -> tuple[bool, int]:
-    left_buffer = bytearray(CHUNK_SIZE)
-    right_buffer = bytearray(CHUNK_SIZE)
-    left_view = memoryview(left_buffer)
+def drain_stream(reader: StreamHandle, hasher: Optional[ContentHasher] = None) -> int:
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    total = 0
+    try:
+        while True:
+            chunk = read_chunk_into(reader.stream, buffer, view)
+            if not chunk:
+                return total
+            if hasher is not None:
+                hasher.update(chunk)
+            total += len(chunk)
+    finally:
+        reader.close()
+
+
+def compare_streams(left_handle: StreamHandle, right_handle: StreamHandle, hasher: Optional[ContentHasher] = None) -> tuple[bool, int]:
+    left_buffers = [bytearray(COMPARE_CHUNK_SIZE), bytearray(COMPARE_CHUNK_SIZE)]
+    left_views = [memoryview(buffer) for buffer in left_buffers]
+    right_buffer = bytearray(COMPARE_CHUNK_SIZE)
     right_view = memoryview(right_buffer)
     total = 0
+    reached_end = False
+    left_reader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
     try:
+        index = 0
+        left_future = left_reader.submit(read_chunk_into, left_handle.stream, left_buffers[index], left_views[index])
         while True:
-            left_chunk = read_chunk_into(left_handle.stream, left_buffer, left_view)
             right_chunk = read_chunk_into(right_handle.stream, right_buffer, right_view)
-            if len(left_chunk) != len(right_chunk):
+            left_chunk = left_future.result()
+            if len(left_chunk) != len(right_chunk) or left_chunk != right_chunk:
                 return False, total
             if not left_chunk:
+                reached_end = True
                 return True, total
-            if left_chunk != right_chunk:
-                return False, total
+            index ^= 1
+            left_future = left_reader.submit(read_chunk_into, left_handle.stream, left_buffers[index], left_views[index])
+            if hasher is not None:
+                hasher.update(left_chunk)
             total += len(left_chunk)
     finally:
-        left_handle.close()
-        right_handle.close()
-
-
-def write_compressed_stream(reader: StreamHandle, target_path: str, codec_name: str, opts: list[str]) -> tuple[int, int]:
-    target_dir = os.path.dirname(target_path)
-    os.makedirs(target_dir, exist_ok=True)
-    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(target_path)}.", suffix=".tmp", dir=target_dir)
-    os.close(fd)
-    try:
-        with open(tmp_path, "wb") as out_fh:
-            if codec_name == "none":
-                uncompressed_size = copy_stream(reader, out_fh)
-            else:
-                proc = subprocess.Popen(
-                    get_codec(codec_name).compress_command(opts),
-                    stdin=subprocess.PIPE,
-                    stdout=out_fh,
-                    stderr=subprocess.DEVNULL,
-                )
-                assert proc.stdin is not None
+        try:
+            if reached_end:
                 try:
-                    uncompressed_size = copy_stream(reader, proc.stdin)
-                    proc.stdin.close()
-                except Exception:
-                    proc.kill()
-                    raise
-                ret = proc.wait()
-                if ret != 0:
-                    raise subprocess.CalledProcessError(ret, proc.args)
+                    left_handle.close()
+                finally:
+                    right_handle.close()
+            else:
+                left_handle.abort()
+                right_handle.abort()
+                for handle in (left_handle, right_handle):
+                    if handle.feed_error is not None:
+                        raise handle.feed_error
+        finally:
+            left_reader.shutdown(wait=True, cancel_futures=True)
+
+
+def write_compressed_stream(
+    reader: StreamHandle,
+    target_path: str,
+    codec_name: str,
+    opts: list[str],
+    in_process: bool = False,
+    hasher: Optional[ContentHasher] = None,
+    blocks: Optional[BlockSettings] = None,
+) -> tuple[int, int]:
+    tmp_path = create_temp_output(target_path)
+    try:
+        with IO_GOVERNOR.writer(open(tmp_path, "wb")) as out_fh:
+            uncompressed_size = compress_to_file(reader, out_fh, codec_name, opts, in_process, hasher, blocks)
         return finalize_temp_output(tmp_path, target_path), uncompressed_size
     except Exception:
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
+        discard_temp_output(tmp_path)
+        raise
+
+
+def compress_to_file(
+    reader: StreamHandle,
+    out_fh: BinaryIO,
+    codec_name: str,
+    opts: list[str],
+    in_process: bool = False,
+    hasher: Optional[ContentHasher] = None,
+    blocks: Optional[BlockSettings] = None,
+) -> int:
+    if codec_name == "none":
+        return copy_stream(reader, out_fh, hasher)
+    if blocks is not None:
+        return compress_blocks(reader, out_fh, codec_name, opts, in_process, hasher, blocks)
+    compressor = in_process_compressor(codec_name, opts, in_process)
+    if compressor is not None:
+        return compress_stream(reader, out_fh, compressor, hasher)
+    out_fd = file_descriptor(out_fh)
+    proc = subprocess.Popen(
+        get_codec(codec_name).compress_command(opts),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE if out_fd is None else out_fd,
+        stderr=subprocess.DEVNULL,
+    )
+    assert proc.stdin is not None
+    enlarge_pipe(proc.stdin.fileno())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pump:
+        drained = pump.submit(drain_process_output, proc, out_fh) if proc.stdout is not None else None
+        try:
+            uncompressed_size = copy_stream(reader, proc.stdin, hasher)
+            proc.stdin.close()
+        except Exception:
+            proc.kill()
+            raise
+        with STAGE_CLOCK.measure("compress"):
+            if drained is not None:
+                drained.result()
+            ret = wait_process(proc, "compress")
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, proc.args)
+    return uncompressed_size
+
+
+class BlockPool:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.lock = threading.Lock()
+        self.executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.slots: Optional[threading.Semaphore] = None
+
+    def start(self, workers: int) -> tuple[concurrent.futures.ThreadPoolExecutor, threading.Semaphore]:
+        with self.lock:
+            if self.executor is None or self.slots is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.name)
+                self.slots = threading.Semaphore(workers * BLOCK_IN_FLIGHT_FACTOR)
+            return self.executor, self.slots
+
+
+DECODE_POOL = BlockPool("decode")
+
+
+def single_thread_opts(opts: list[str]) -> list[str]:
+    kept: list[str] = []
+    skip_next = False
+    for opt in opts:
+        if skip_next:
+            skip_next = False
+        elif opt in ("-T", "--threads"):
+            skip_next = True
+        elif not THREADS_OPT_RE.fullmatch(opt):
+            kept.append(opt)
+    return kept
+
+
+def plan_parallel_decode(fh: BinaryIO, codec_name: str) -> Optional[list[tuple[int, int]]]:
+    walker = MEMBER_WALKERS.get(codec_name)
+    file_size = os.fstat(fh.fileno()).st_size
+    if walker is None or file_size < PARALLEL_DECODE_MIN_SIZE:
+        return None
+    ranges: list[tuple[int, int]] = []
+    start = end = 0
+    try:
+        for member in walker(fh, file_size, None, PARALLEL_DECODE_MAX_MEMBER):
+            if member.offset != end or member.offset + member.length - start > PARALLEL_DECODE_CHUNK_SIZE:
+                if end > start:
+                    ranges.append((start, end - start))
+                start = member.offset
+            end = member.offset + member.length
+    except (OSError, ValueError, IndexError):
+        return None
+    if end > start:
+        ranges.append((start, end - start))
+    return ranges if len(ranges) > 1 else None
+
+
+def decode_chunk(data: bytes, codec_name: str, in_process: bool) -> bytes:
+    reader = in_process_reader(codec_name, in_process)
+    if reader is not None:
+        with reader(io.BytesIO(data)) as stream:
+            return stream.read()
+    return run_codec_process(get_codec(codec_name).decompress_command("/dev/stdin"), data, "decompress")
+
+
+class ParallelDecodeReader(io.RawIOBase):
+    def __init__(
+        self,
+        fh: BinaryIO,
+        ranges: list[tuple[int, int]],
+        decode: Callable[[bytes], bytes],
+        executor: concurrent.futures.ThreadPoolExecutor,
+        depth: int,
+    ) -> None:
+        self.fh = fh
+        self.ranges = collections.deque(ranges)
+        self.decode = decode
+        self.executor = executor
+        self.depth = depth
+        self.pending: collections.deque[concurrent.futures.Future[bytes]] = collections.deque()
+        self.chunk = memoryview(b"")
+        self.fill()
+
+    def fill(self) -> None:
+        while self.ranges and len(self.pending) < self.depth:
+            offset, length = self.ranges.popleft()
+            IO_GOVERNOR.charge_read(length)
+            self.pending.append(self.executor.submit(self.decode, read_exact_at(self.fh, offset, length)))
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray | memoryview) -> int:
+        while not self.chunk:
+            if not self.pending:
+                return 0
+            self.chunk = memoryview(self.pending.popleft().result())
+            self.fill()
+        count = min(len(buffer), len(self.chunk))
+        buffer[:count] = self.chunk[:count]
+        self.chunk = self.chunk[count:]
+        return count
+
+    def close(self) -> None:
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        super().close()
+
+
+def open_parallel_decoded_stream(path: str, codec_name: str, in_process: bool, threads: int) -> Optional[StreamHandle]:
+    fh = open(path, "rb")
+    try:
+        ranges = plan_parallel_decode(fh, codec_name)
+        if ranges is not None:
+            executor, _ = DECODE_POOL.start(threads)
+            decode = STAGE_CLOCK.bind("decompress", functools.partial(decode_chunk, codec_name=codec_name, in_process=in_process))
+            return StreamHandle(ParallelDecodeReader(fh, ranges, decode, executor, threads * BLOCK_IN_FLIGHT_FACTOR), [], [fh])
+        file_size = os.fstat(fh.fileno()).st_size
+    except BaseException:
+        fh.close()
+        raise
+    fh.close()
+    if codec_name not in THREADED_DECODERS or IO_GOVERNOR.meters_reads or file_size < PARALLEL_DECODE_MIN_SIZE or in_process_reader(codec_name, in_process) is not None:
+        return None
+    command = get_codec(codec_name).decompress_command(path)
+    proc = subprocess.Popen([command[0], f"-T{threads}", *command[1:]], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    assert proc.stdout is not None
+    enlarge_pipe(proc.stdout.fileno())
+    return StreamHandle(proc.stdout, [proc], [], raw_fd=proc.stdout.fileno())
+
+
+def compress_block(block: bytes | memoryview, codec_name: str, opts: list[str], in_process: bool) -> bytes:
+    compressor = in_process_compressor(codec_name, opts, in_process)
+    if compressor is not None:
+        return compressor.compress(block) + compressor.flush()
+    return run_codec_process(get_codec(codec_name).compress_command(opts), block, "compress")
+
+
+def compress_blocks(
+    reader: StreamHandle,
+    out_fh: BinaryIO,
+    codec_name: str,
+    opts: list[str],
+    in_process: bool,
+    hasher: Optional[ContentHasher],
+    blocks: BlockSettings,
+) -> int:
+    opts = single_thread_opts(opts)
+    depth = blocks.workers * BLOCK_IN_FLIGHT_FACTOR
+    pending: collections.deque[concurrent.futures.Future[bytes]] = collections.deque()
+    total = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=blocks.workers, thread_name_prefix="block") as executor:
+        try:
+            while True:
+                buffer = bytearray(blocks.size)
+                with STAGE_CLOCK.measure("decompress"):
+                    block = read_chunk_into(reader.stream, buffer, memoryview(buffer))
+                if not block and total > 0:
+                    break
+                if hasher is not None:
+                    hasher.update(block)
+                total += len(block)
+                with STAGE_CLOCK.measure("compress"):
+                    while len(pending) >= depth:
+                        out_fh.write(pending.popleft().result())
+                pending.append(executor.submit(STAGE_CLOCK.bind("compress", compress_block), block, codec_name, opts, in_process))
+                if not block:
+                    break
+            with STAGE_CLOCK.measure("compress"):
+                while pending:
+                    out_fh.write(pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
+    return total
+
+
+def block_settings(task: FileTask, config: Config) -> Optional[BlockSettings]:
+    if config.block_size is None or task.input_size <= config.block_size:
+        return None
+    return BlockSettings(size=config.block_size, workers=job_thread_share(config))
+
+
+def job_thread_share(config: Config) -> int:
+    return max(1, config.max_threads // (config.jobs or default_local_jobs()))
+
+
+def decode_thread_count(config: Config) -> int:
+    return min(config.decode_threads, job_thread_share(config))
+
+
+def block_resource_cost(conversion_cost: ResourceCost, blocks: BlockSettings) -> ResourceCost:
+    thread_memory = conversion_cost.memory // max(conversion_cost.threads, 1)
+    return ResourceCost(
+        threads=blocks.workers,
+        memory=(thread_memory + blocks.size * BLOCK_IN_FLIGHT_FACTOR) * blocks.workers,
+    )
+
+
+def create_temp_output(target_path: str) -> str:
+    target_dir = os.path.dirname(target_path)
+    os.makedirs(target_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(target_path)}.", suffix=".tmp", dir=target_dir)
+    os.close(fd)
+    return tmp_path
+
+
+def discard_temp_output(tmp_path: str) -> None:
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+
+
+def clone_file_into(source_path: str, out_fh: BinaryIO) -> None:
+    with open(source_path, "rb") as in_fh:
+        try:
+            fcntl.ioctl(out_fh.fileno(), FICLONE, in_fh.fileno())
+            return
+        except OSError:
+            pass
+        if IO_GOVERNOR.meters_reads or IO_GOVERNOR.meters_writes:
+            with IO_GOVERNOR.writer(out_fh) as metered_out:
+                shutil.copyfileobj(IO_GOVERNOR.reader(in_fh), metered_out, CHUNK_SIZE)
+        elif kernel_copy(in_fh.fileno(), out_fh.fileno()) is None:
+            shutil.copyfileobj(in_fh, out_fh, CHUNK_SIZE)
+
+
+def write_passthrough_copy(source_path: str, target_path: str) -> int:
+    tmp_path = create_temp_output(target_path)
+    try:
+        with open(tmp_path, "wb") as out_fh, STAGE_CLOCK.measure("copy"):
+            clone_file_into(source_path, out_fh)
+        return finalize_temp_output(tmp_path, target_path)
+    except Exception:
+        discard_temp_output(tmp_path)
         raise
 
 
 def finalize_temp_output(tmp_path: str, target_path: str) -> int:
-    output_size = os.path.getsize(tmp_path)
-    os.replace(tmp_path, target_path)
+    with STAGE_CLOCK.measure("finalize"):
+        output_size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, target_path)
     return output_size
 
 
-def can_use_external_compare() -> bool:
-    return shutil.which("cmp") is not None and shutil.which("bash") is not None
+def compare_uncompressed_streams(
+    source_path: str,
+    source_format: str,
+    target_path: str,
+    target_format: str,
+    in_process: bool = False,
+    hasher: Optional[ContentHasher] = None,
+) -> tuple[bool, Optional[int]]:
+    source_handle = open_decompressed_stream(source_path, source_format, in_process)
+    try:
+        target_handle = open_decompressed_stream(target_path, target_format, in_process)
+    except Exception:
+        source_handle.abort()
+        raise
+    matches, total = compare_streams(source_handle, target_handle, hasher)
+    return matches, total if matches else None
 
 
-def run_compare_command(script: str) -> bool:
-    result = subprocess.run(["bash", "-lc", script], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    if result.returncode == 0:
-        return True
-    if result.returncode == 1:
-        return False
-    raise subprocess.CalledProcessError(result.returncode, ["bash", "-lc", script])
+def hash_uncompressed_stream(path: str, codec_name: str, in_process: bool = False) -> tuple[str, int]:
+    hasher = new_content_hasher()
+    size = drain_stream(open_decompressed_stream(path, codec_name, in_process), hasher)
+    return hasher.hexdigest(), size
 
 
-def decompressed_shell_command(path: str, codec_name: str) -> str:
-    if codec_name == "none":
-        return shlex.join(["cat", "--", path])
-    return shlex.join(get_codec(codec_name).decompress_command(path))
-
-
-def compare_raw_files(left_path: str, right_path: str) -> tuple[bool, int]:
-    if can_use_external_compare():
-        matches = subprocess.run(["cmp", "-s", "--", left_path, right_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if matches.returncode == 0:
-            return True, os.path.getsize(left_path)
-        if matches.returncode == 1:
-            return False, 0
-        raise subprocess.CalledProcessError(matches.returncode, matches.args)
-    left_handle = StreamHandle(open(left_path, "rb"), [], [])
-    right_handle = StreamHandle(open(right_path, "rb"), [], [])
-    return compare_streams(left_handle, right_handle)
-
-
-def compare_uncompressed_streams(source_path: str, source_format: str, target_path: str, target_format: str) -> tuple[bool, Optional[int]]:
-    if can_use_external_compare():
-        source_cmd = decompressed_shell_command(source_path, source_format)
-        target_cmd = decompressed_shell_command(target_path, target_format)
-        return run_compare_command(f"cmp -s <({source_cmd}) <({target_cmd})"), None
-    source_handle = open_decompressed_stream(source_path, source_format)
-    target_handle = open_decompressed_stream(target_path, target_format)
-    matches, total = compare_streams(source_handle, target_handle)
-    return matches, total if matches else None
+def read_exact_at(fh: BinaryIO, offset: int, size: int) -> bytes:
+    if offset < 0:
+        raise ValueError("offset before start of file")
+    fh.seek(offset)
+    data = fh.read(size)
+    if len(data) != size:
+        raise ValueError("truncated container")
+    return data
+
+
+def read_le(fh: BinaryIO, offset: int, size: int) -> int:
+    return int.from_bytes(read_exact_at(fh, offset, size), "little")
+
+
+def read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("invalid xz varint")
+
+
+def bgzf_block_size(extra: bytes) -> Optional[int]:
+    pos = 0
+    while pos + 4 <= len(extra):
+        subfield_len = int.from_bytes(extra[pos + 2 : pos + 4], "little")
+        if extra[pos : pos + 2] == b"BC" and subfield_len == 2:
+            return int.from_bytes(extra[pos + 4 : pos + 6], "little") + 1
+        pos += 4 + subfield_len
+    return None
+
+
+def iter_bgzf_members(
+    fh: BinaryIO,
+    file_size: int,
+    max_reads: Optional[int] = None,
+    max_member: Optional[int] = None,
+) -> Iterator[ContainerMember]:
+    offset = 0
+    reads = 0
+    while offset < file_size:
+        reads += 1
+        if max_reads is not None and reads > max_reads:
+            raise ValueError("container walk limit reached")
+        header = read_exact_at(fh, offset, 12)
+        block_size = None
+        if header[:3] == b"\x1f\x8b\x08" and header[3] & 0x04:
+            block_size = bgzf_block_size(read_exact_at(fh, offset + 12, int.from_bytes(header[10:12], "little")))
+        if block_size is None:
+            if max_member is not None and file_size - offset > max_member:
+                raise ValueError("container member too large")
+            yield ContainerMember(offset, file_size - offset, None)
+            return
+        yield ContainerMember(offset, block_size, read_le(fh, offset + block_size - 4, 4))
+        offset += block_size
+
+
+def iter_zstd_frames(
+    fh: BinaryIO,
+    file_size: int,
+    max_reads: Optional[int] = None,
+    max_member: Optional[int] = None,
+    sized: bool = False,
+) -> Iterator[ContainerMember]:
+    offset = 0
+    reads = 0
+    while offset < file_size:
+        reads += 1
+        if max_reads is not None and reads > max_reads:
+            raise ValueError("container walk limit reached")
+        magic = read_le(fh, offset, 4)
+        if magic & 0xFFFFFFF0 == ZSTD_SKIPPABLE_MAGIC:
+            offset += 8 + read_le(fh, offset + 4, 4)
+            continue
+        if magic != ZSTD_FRAME_MAGIC:
+            raise ValueError("not a zstd frame")
+        frame_offset = offset
+        descriptor = read_exact_at(fh, offset + 4, 1)[0]
+        single_segment = descriptor >> 5 & 1
+        content_size_bytes = (single_segment, 2, 4, 8)[descriptor >> 6]
+        content_size_offset = offset + 5 + (1 - single_segment) + (0, 1, 2, 4)[descriptor & 3]
+        content_size = None
+        if content_size_bytes:
+            content_size = read_le(fh, content_size_offset, content_size_bytes) + (256 if content_size_bytes == 2 else 0)
+        elif sized:
+            raise ValueError("zstd frame without content size")
+        offset = content_size_offset + content_size_bytes
+        while True:
+            reads += 1
+            if max_reads is not None and reads > max_reads:
+                raise ValueError("container walk limit reached")
+            block_header = read_le(fh, offset, 3)
+            block_type = block_header >> 1 & 3
+            if block_type == 3:
+                raise ValueError("reserved zstd block type")
+            offset += 3 + (1 if block_type == 1 else block_header >> 3)
+            if max_member is not None and offset - frame_offset > max_member:
+                raise ValueError("container member too large")
+            if block_header & 1:
+                break
+        offset += 4 if descriptor & 0x04 else 0
+        yield ContainerMember(frame_offset, offset - frame_offset, content_size)
+
+
+def iter_xz_streams(
+    fh: BinaryIO,
+    file_size: int,
+    max_reads: Optional[int] = None,
+    max_member: Optional[int] = None,
+) -> Iterator[ContainerMember]:
+    streams: list[ContainerMember] = []
+    end = file_size
+    while end > 0:
+        if max_reads is not None and len(streams) >= max_reads:
+            raise ValueError("container walk limit reached")
+        while end >= 4 and read_exact_at(fh, end - 4, 4) == b"\0\0\0\0":
+            end -= 4
+        footer = read_exact_at(fh, end - 12, 12)
+        if footer[10:12] != b"YZ":
+            raise ValueError("missing xz stream footer")
+        index_size = (int.from_bytes(footer[4:8], "little") + 1) * 4
+        if index_size > PROBE_MAX_INDEX_SIZE:
+            raise ValueError("xz index too large")
+        index = read_exact_at(fh, end - 12 - index_size, index_size)
+        if index[0] != 0:
+            raise ValueError("invalid xz index")
+        record_count, pos = read_varint(index, 1)
+        blocks_size = 0
+        uncompressed_total = 0
+        for _ in range(record_count):
+            unpadded_size, pos = read_varint(index, pos)
+            uncompressed_size, pos = read_varint(index, pos)
+            blocks_size += (unpadded_size + 3) & ~3
+            uncompressed_total += uncompressed_size
+        stream_size = 12 + blocks_size + index_size + 12
+        if max_member is not None and stream_size > max_member:
+            raise ValueError("container member too large")
+        end -= stream_size
+        if read_exact_at(fh, end, len(XZ_STREAM_MAGIC)) != XZ_STREAM_MAGIC:
+            raise ValueError("missing xz stream header")
+        streams.append(ContainerMember(end, stream_size, uncompressed_total))
+    yield from reversed(streams)
+
+
+def probe_members_size(members: Iterator[ContainerMember], file_size: int) -> Optional[int]:
+    total = 0
+    for member in members:
+        if member.uncompressed_size is None:
+            return None
+        total += member.uncompressed_size
+    return total if file_size else None
+
 
+def probe_lzma_size(fh: BinaryIO, file_size: int) -> Optional[int]:
+    size = read_le(fh, 5, 8)
+    return None if size == LZMA_UNKNOWN_SIZE else size
 
-def verified_outcome(task: FileTask, reason: str, target: TargetSnapshot, uncompressed_size: Optional[int] = None) -> TaskOutcome:
+
+def probe_zstd_size(fh: BinaryIO, file_size: int) -> Optional[int]:
+    return probe_members_size(iter_zstd_frames(fh, file_size, PROBE_MAX_READS, None, sized=True), file_size)
+
+
+MEMBER_WALKERS: dict[str, Callable[[BinaryIO, int, Optional[int], Optional[int]], Iterator[ContainerMember]]] = {
+    "gzip": iter_bgzf_members,
+    "xz": iter_xz_streams,
+    "zstd": iter_zstd_frames,
+}
+
+
+SIZE_PROBES: dict[str, Callable[[BinaryIO, int], Optional[int]]] = {
+    "none": lambda fh, file_size: file_size,
+    "lzma": probe_lzma_size,
+    "zstd": probe_zstd_size,
+}
+
+
+def probe_uncompressed_size(path: str, codec_name: str) -> Optional[int]:
+    probe = SIZE_PROBES.get(codec_name)
+    walker = MEMBER_WALKERS.get(codec_name)
+    if walker is None and probe is None:
+        return None
+    try:
+        with open(path, "rb") as fh:
+            file_size = os.fstat(fh.fileno()).st_size
+            if probe is not None:
+                return probe(fh, file_size)
+            assert walker is not None
+            return probe_members_size(walker(fh, file_size, PROBE_MAX_READS, None), file_size)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def probe_pair_uncompressed_size(task: FileTask, config: Config) -> Optional[int]:
+    if task.input_format == "none":
+        return task.input_size
+    if task.input_format in INDEXED_SIZE_CODECS and config.compressor not in INDEXED_SIZE_CODECS:
+        return probe_uncompressed_size(task.source_path, task.input_format)
+    return probe_uncompressed_size(task.target_path, config.compressor)
+
+
+def verified_outcome(
+    task: FileTask,
+    reason: str,
+    target: TargetSnapshot,
+    uncompressed_size: Optional[int] = None,
+    content_hash: Optional[str] = None,
+) -> TaskOutcome:
     return TaskOutcome(
         action=OutcomeAction.VERIFIED,
         source_rel=task.source_rel,
@@ -661,6 +2616,8 @@ def verified_outcome(task: FileTask, reason: str, target: TargetSnapshot, uncomp
         input_size=task.input_size,
         output_size=target.size,
         uncompressed_size=uncompressed_size,
+        source_mtime_ns=task.source_mtime_ns,
+        content_hash=content_hash,
     )
 
 
@@ -679,7 +2636,7 @@ def target_outcome(action: OutcomeAction, size: int) -> TaskOutcome:
     return TaskOutcome(action=action, output_size=size)
 
 
-def plan_file_work(task: FileTask, config: Config, target: Optional[TargetSnapshot]) -> WorkItem:
+def plan_file_work(task: FileTask, config: Config, target: Optional[TargetSnapshot], manifest_entry: Optional[ManifestEntry] = None) -> WorkItem:
     if target is None:
         return WorkItem(action=WorkAction.CONVERT, reason="target missing", task=task)
     if not stat.S_ISREG(target.mode):
@@ -687,7 +2644,9 @@ def plan_file_work(task: FileTask, config: Config, target: Optional[TargetSnapsh
     if task.source_mtime_ns > target.mtime_ns:
         return WorkItem(action=WorkAction.CONVERT, reason="source newer than target", task=task, target=target)
     if config.compare_bytes:
-        return WorkItem(action=WorkAction.VERIFY_BYTES, reason="verify uncompressed bytes", task=task, target=target)
+        return WorkItem(action=WorkAction.VERIFY_BYTES, reason="verify uncompressed bytes", task=task, target=target, manifest=manifest_entry)
+    if manifest_entry is not None:
+        return WorkItem(action=WorkAction.VERIFY_METADATA, reason="manifest entry matches", task=task, target=target, manifest=manifest_entry)
     return WorkItem(action=WorkAction.VERIFY_METADATA, reason="target exists and mtime matches", task=task, target=target)
 
 
@@ -703,32 +2662,129 @@ def resolve_verification_work_item(item: WorkItem, config: Config) -> WorkItem |
     task = item.task
     target = item.target
 
+    entry = item.manifest
     if item.action == WorkAction.VERIFY_METADATA:
-        return verified_outcome(task, "target exists and mtime matches", target)
-    matches, size = compare_uncompressed_streams(task.source_path, task.input_format, task.target_path, config.compressor)
+        uncompressed_size = entry.uncompressed_size if entry is not None else None
+        if uncompressed_size is None:
+            uncompressed_size = probe_pair_uncompressed_size(task, config)
+        return verified_outcome(task, item.reason, target, uncompressed_size, entry.content_hash if entry is not None else None)
+    source_size = probe_uncompressed_size(task.source_path, task.input_format)
+    target_size = probe_uncompressed_size(task.target_path, config.compressor)
+    if source_size is not None and target_size is not None and source_size != target_size:
+        return WorkItem(action=WorkAction.CONVERT, reason="uncompressed size mismatch", task=task, target=target)
+    if entry is not None and entry.content_hash is not None and entry.uncompressed_size is not None:
+        if config.scrub:
+            digest, size = hash_uncompressed_stream(task.target_path, config.compressor, config.in_process)
+            reason = "target matches recorded uncompressed hash"
+        else:
+            digest, size = hash_uncompressed_stream(task.source_path, task.input_format, config.in_process)
+            reason = "source matches recorded uncompressed hash"
+        if digest == entry.content_hash and size == entry.uncompressed_size:
+            return verified_outcome(task, reason, target, size, digest)
+        return WorkItem(action=WorkAction.CONVERT, reason="uncompressed content mismatch", task=task, target=target)
+    hasher = new_content_hasher() if config.manifest else None
+    matches, size = compare_uncompressed_streams(task.source_path, task.input_format, task.target_path, config.compressor, config.in_process, hasher)
     if matches:
-        return verified_outcome(task, "mtime and uncompressed bytes match", target, uncompressed_size=size)
+        content_hash = hasher.hexdigest() if hasher is not None else None
+        return verified_outcome(task, "mtime and uncompressed bytes match", target, size, content_hash)
     return WorkItem(action=WorkAction.CONVERT, reason="uncompressed content mismatch", task=task, target=target)
 
 
+def trial_compress_seconds(sample: bytes, codec_name: str, opts: list[str], in_process: bool) -> float:
+    started = time.perf_counter()
+    compressor = in_process_compressor(codec_name, opts, in_process)
+    if compressor is not None:
+        compressor.compress(sample)
+        compressor.flush()
+    else:
+        subprocess.run(get_codec(codec_name).compress_command(opts), input=sample, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - started
+
+
+def sample_compression_ratio(sample: bytes) -> float:
+    return len(zlib.compress(sample, 1)) / len(sample) if sample else 0.0
+
+
+def choose_compress_opts(reader: StreamHandle, task: FileTask, config: Config, policy: Optional[LevelPolicy]) -> tuple[list[str], str]:
+    base_opts = [opt for opt in config.compress_opts if not LEVEL_OPT_RE.fullmatch(opt)]
+    if config.incompressible != "off" and task.input_size >= INCOMPRESSIBLE_MIN_SIZE:
+        sample = reader.peek_prefix(ADAPTIVE_SAMPLE_SIZE)
+        if sample_compression_ratio(sample) >= config.incompressible_ratio:
+            return [f"-{ADAPTIVE_LEVELS[config.compressor][0]}", *base_opts], "incompressible"
+    if policy is None:
+        return config.compress_opts, ""
+    level = policy.fallback_level
+    if task.input_size >= ADAPTIVE_TRIAL_MIN_SIZE:
+        sample = reader.peek_prefix(ADAPTIVE_SAMPLE_SIZE)
+        level = config.adaptive_levels[0]
+        for candidate in config.adaptive_levels:
+            seconds = trial_compress_seconds(sample, config.compressor, [f"-{candidate}", *base_opts], config.in_process)
+            if seconds > 0 and len(sample) / seconds < policy.min_speed:
+                break
+            level = candidate
+    return [f"-{level}", *base_opts], f"level {level}"
+
+
 def execute_convert_work_item(item: WorkItem, config: Config) -> TaskOutcome:
     assert item.task is not None
     task = item.task
     if config.dry_run:
         return convert_outcome(task, item.reason)
-    reader = open_decompressed_stream(task.source_path, task.input_format)
-    try:
-        output_size, uncompressed_size = write_compressed_stream(reader, task.target_path, config.compressor, config.compress_opts)
-    finally:
-        reader.close()
-    shutil.copystat(task.source_path, task.target_path, follow_symlinks=False)
+    if config.passthrough != "off" and task.input_format == config.compressor:
+        return execute_passthrough_work_item(task, config)
+    hasher = new_content_hasher() if config.manifest else None
+    with STAGE_CLOCK.span("convert"):
+        reader = open_decompressed_stream(task.source_path, task.input_format, config.in_process, decode_thread_count(config))
+        try:
+            compress_opts, encoding = choose_compress_opts(reader, task, config, item.level_policy)
+            output_size, uncompressed_size = write_compressed_stream(
+                reader,
+                task.target_path,
+                config.compressor,
+                compress_opts,
+                config.in_process,
+                hasher,
+                block_settings(task, config),
+            )
+        finally:
+            reader.close()
+    with STAGE_CLOCK.measure("copystat"):
+        shutil.copystat(task.source_path, task.target_path, follow_symlinks=False)
     return TaskOutcome(
         action=OutcomeAction.CONVERTED,
         source_rel=task.source_rel,
         target_rel=task.target_rel,
+        input_format=task.input_format,
+        input_size=task.input_size,
+        output_size=output_size,
+        uncompressed_size=uncompressed_size,
+        source_mtime_ns=task.source_mtime_ns,
+        content_hash=hasher.hexdigest() if hasher is not None else None,
+        encoding=encoding,
+    )
+
+
+def execute_passthrough_work_item(task: FileTask, config: Config) -> TaskOutcome:
+    uncompressed_size: Optional[int] = None
+    content_hash: Optional[str] = None
+    if config.passthrough == "test":
+        hasher = new_content_hasher() if config.manifest else None
+        uncompressed_size = drain_stream(open_decompressed_stream(task.source_path, task.input_format, config.in_process, decode_thread_count(config)), hasher)
+        content_hash = hasher.hexdigest() if hasher is not None else None
+    output_size = write_passthrough_copy(task.source_path, task.target_path)
+    with STAGE_CLOCK.measure("copystat"):
+        shutil.copystat(task.source_path, task.target_path, follow_symlinks=False)
+    return TaskOutcome(
+        action=OutcomeAction.CONVERTED,
+        source_rel=task.source_rel,
+        target_rel=task.target_rel,
+        input_format=task.input_format,
         input_size=task.input_size,
         output_size=output_size,
         uncompressed_size=uncompressed_size,
+        source_mtime_ns=task.source_mtime_ns,
+        content_hash=content_hash,
+        encoding="passthrough",
     )
 
 
@@ -755,16 +2811,89 @@ def execute_target_work_item(item: WorkItem, config: Config, reporter: Optional[
 
 
 def execute_work_item(item: WorkItem, config: Config) -> TaskOutcome:
+    with STAGE_CLOCK.collect(StageTimings(trace_enabled(config))) as timings:
+        outcome = run_work_item(item, config)
+    return dataclasses.replace(outcome, timings=timings.totals, trace=timings.trace_payload())
+
+
+def run_work_item(item: WorkItem, config: Config) -> TaskOutcome:
     if item.action in (WorkAction.VERIFY_METADATA, WorkAction.VERIFY_BYTES):
-        resolved = resolve_verification_work_item(item, config)
+        with STAGE_CLOCK.measure("verify"):
+            resolved = resolve_verification_work_item(item, config)
         if isinstance(resolved, TaskOutcome):
             return resolved
-        return execute_convert_work_item(resolved, config)
+        return execute_convert_work_item(dataclasses.replace(resolved, level_policy=item.level_policy), config)
     if item.action == WorkAction.CONVERT:
         return execute_convert_work_item(item, config)
     return execute_target_work_item(item, config)
 
 
+def execute_work_batch(items: list[WorkItem], config: Config) -> list[TaskOutcome]:
+    return [execute_work_item(item, config) for item in items]
+
+
+def batch_resource_cost(items: list[WorkItem], conversion_cost: ResourceCost, config: Config) -> ResourceCost:
+    if all(item.action == WorkAction.VERIFY_METADATA for item in items):
+        return ResourceCost(threads=0, memory=0)
+    for item in items:
+        blocks = block_settings(item.task, config) if item.action == WorkAction.CONVERT and item.task is not None else None
+        if blocks is not None:
+            return block_resource_cost(conversion_cost, blocks)
+    return conversion_cost
+
+
+class AdmissionController:
+    def __init__(self, max_threads: int, max_memory: Optional[int]) -> None:
+        self.max_threads = max_threads
+        self.max_memory = max_memory
+        self.threads = 0
+        self.memory = 0
+
+    def try_acquire(self, cost: ResourceCost) -> bool:
+        busy = self.threads > 0 or self.memory > 0
+        if busy and self.threads + cost.threads > self.max_threads:
+            return False
+        if busy and self.max_memory is not None and self.memory + cost.memory > self.max_memory:
+            return False
+        self.threads += cost.threads
+        self.memory += cost.memory
+        return True
+
+    def release(self, cost: ResourceCost) -> None:
+        self.threads -= cost.threads
+        self.memory -= cost.memory
+
+
+class InFlightWindow:
+    def __init__(self, config: Config, jobs: int) -> None:
+        self.high = config.in_flight_high or jobs * DEFAULT_IN_FLIGHT_PER_JOB
+        self.low = min(self.high, self.high // 2 if config.in_flight_low is None else config.in_flight_low)
+        self.max_batches = jobs * IN_FLIGHT_BATCHES_PER_JOB
+        self.batches = 0
+        self.files = 0
+        self.bytes = 0
+        self.draining = False
+
+    def add(self, items: list[WorkItem]) -> int:
+        size = sum(work_item_cost(item) for item in items)
+        self.batches += 1
+        self.files += len(items)
+        self.bytes += size
+        if self.bytes >= self.high:
+            self.draining = True
+        return size
+
+    def remove(self, files: int, size: int) -> None:
+        self.batches -= 1
+        self.files -= files
+        self.bytes -= size
+        if self.bytes <= self.low:
+            self.draining = False
+
+    def full(self) -> bool:
+        return self.batches > 0 and (self.draining or self.batches >= self.max_batches)
+
+
 def print_table_border() -> None:
     print("+----------------------+----------+------------------+------------------+------------------+")
 
@@ -783,6 +2912,9 @@ class ProgressDisplay:
         self.last_width = 0
         self.visible = False
         self.refresh_interval = 0.25
+        self.window: Optional[InFlightWindow] = None
+        self.estimate: Optional[SourceEstimate] = None
+        self.samples: collections.deque[tuple[float, int, int]] = collections.deque()
 
     def start_cleanup(self) -> None:
         self.phase = "cleanup"
@@ -804,7 +2936,7 @@ class ProgressDisplay:
         now = time.monotonic()
         if not force and self.visible and now - self.last_render < self.refresh_interval:
             return
-        line = self._build_line()
+        line = self._build_line(now)
         padded = line
         if len(line) < self.last_width:
             padded = line + (" " * (self.last_width - len(line)))
@@ -817,7 +2949,18 @@ class ProgressDisplay:
     def finish(self) -> None:
         self.clear()
 
-    def _build_line(self) -> str:
+    def _rates(self, now: float, input_bytes: int, output_bytes: int) -> Optional[tuple[float, float, float]]:
+        samples = self.samples
+        samples.append((now, input_bytes, output_bytes))
+        while len(samples) > 2 and samples[1][0] <= now - RATE_WINDOW_SECONDS:
+            samples.popleft()
+        started, input_start, output_start = samples[0]
+        elapsed = now - started
+        if elapsed < 1:
+            return None
+        return elapsed, input_bytes - input_start, output_bytes - output_start
+
+    def _build_line(self, now: float) -> str:
         if self.phase == "cleanup":
             return f"cleanup: deleted {self.stats.buckets['deleted'].files} extra files"
         converted = self.stats.buckets["converted"]
@@ -828,19 +2971,124 @@ class ProgressDisplay:
         output_bytes = converted.output_bytes + verified.output_bytes
         output_known = converted.output_known and verified.output_known
         verified_label = status_label("verified", self.config, lowercase=True)
-        return (
-            f"progress: {done} done | converted {converted.files} | "
-            f"{verified_label} {verified.files} | "
-            f"in {human_size(input_bytes, input_known)} | out {human_size(output_bytes, output_known)}"
-        )
+        estimate = self.estimate if self.estimate is not None and self.estimate.complete else None
+        running = self.window.files if self.window is not None else 0
+        parts = [f"progress: {done}/{estimate.files} done" if estimate is not None else f"progress: {done} done"]
+        if estimate is not None:
+            parts.append(f"queued {max(estimate.files - done - running, 0)}")
+        if self.window is not None:
+            parts.append(f"running {running} ({human_size(self.window.bytes)})")
+        total_input = f"/{human_size(estimate.size)}" if estimate is not None else ""
+        parts += [
+            f"converted {converted.files}",
+            f"{verified_label} {verified.files}",
+            f"in {human_size(input_bytes, input_known)}{total_input}",
+            f"out {human_size(output_bytes, output_known)}",
+        ]
+        rates = self._rates(now, input_bytes, output_bytes)
+        if rates is not None:
+            elapsed, input_delta, output_delta = rates
+            parts.append(f"{format_rate(input_delta, elapsed)} in, {format_rate(output_delta, elapsed)} out")
+            if estimate is not None and input_delta > 0:
+                remaining = max(estimate.size - input_bytes, 0)
+                parts.append(f"ETA {format_duration(remaining * elapsed / input_delta)}")
+        return " | ".join(parts)
+
+
+class SourceEstimate:
+    def __init__(self) -> None:
+        self.files = 0
+        self.size = 0
+        self.complete = False
+
+
+def prescan_source(config: Config, estimate: SourceEstimate) -> None:
+    for entry, _ in iter_file_entries_lex(config.source_dir, scan_jobs=config.scan_jobs):
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        try:
+            estimate.size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+        estimate.files += 1
+    estimate.complete = True
+
+
+def start_source_estimate(config: Config, manifest: Optional[RunManifest]) -> Optional[SourceEstimate]:
+    if config.prescan:
+        estimate = SourceEstimate()
+        threading.Thread(target=prescan_source, args=(config, estimate), name="prescan", daemon=True).start()
+        return estimate
+    if manifest is not None:
+        return manifest.estimate()
+    return None
+
+
+class LevelController:
+    def __init__(self, config: Config, jobs: int) -> None:
+        assert config.target_throughput is not None
+        self.levels = config.adaptive_levels
+        self.target = config.target_throughput * MB
+        self.jobs = jobs
+        self.fallback_level = self.levels[0]
+        self.started = time.monotonic()
+        self.completed_bytes = 0
+        self.pending: dict[str, int] = {}
+        self.pending_bytes = 0
+
+    def policy(self, size: int) -> LevelPolicy:
+        remaining = self.pending_bytes + size
+        budget = (self.completed_bytes + remaining) / self.target - (time.monotonic() - self.started)
+        min_speed = remaining / budget / self.jobs if budget > 0 else float("inf")
+        return LevelPolicy(min_speed=min_speed, fallback_level=self.fallback_level)
+
+    def stamp(self, work_items: Iterator[WorkItem]) -> Iterator[WorkItem]:
+        for item in work_items:
+            if item.action in (WorkAction.CONVERT, WorkAction.VERIFY_BYTES) and item.task is not None:
+                item = dataclasses.replace(item, level_policy=self.policy(item.task.input_size))
+                self.pending[item.task.source_rel] = item.task.input_size
+                self.pending_bytes += item.task.input_size
+            yield item
+
+    def note_outcome(self, outcome: TaskOutcome) -> None:
+        size = self.pending.pop(outcome.source_rel, None)
+        if size is None:
+            return
+        self.pending_bytes -= size
+        self.completed_bytes += size
+        if outcome.encoding.startswith("level ") and size >= ADAPTIVE_TRIAL_MIN_SIZE:
+            self.fallback_level = int(outcome.encoding.removeprefix("level "))
+
+
+def effective_job_count(config: Config) -> int:
+    if config.hosts_file:
+        return sum(host.slots or config.jobs or default_local_jobs() for host in read_hosts_file(config.hosts_file))
+    return config.jobs or default_local_jobs()
 
 
 class Reporter:
-    def __init__(self, config: Config, stats: StatsAccumulator) -> None:
+    def __init__(
+        self,
+        config: Config,
+        stats: StatsAccumulator,
+        manifest: Optional[RunManifest] = None,
+        journal: Optional[RunJournal] = None,
+        level_controller: Optional[LevelController] = None,
+        trace: Optional[RunTrace] = None,
+        metrics: Optional[MetricsExporter] = None,
+    ) -> None:
         self.config = config
         self.stats = stats
+        self.manifest = manifest
+        self.journal = journal
+        self.level_controller = level_controller
+        self.trace = trace
+        self.metrics = metrics
         self.progress = ProgressDisplay(config, stats)
 
+    def span(self, name: str) -> contextlib.AbstractContextManager[None]:
+        return self.trace.span(name) if self.trace is not None else contextlib.nullcontext()
+
     def log_line(self, message: str) -> None:
         if self.config.quiet:
             return
@@ -863,7 +3111,21 @@ class Reporter:
         self.progress.render(force=True)
 
     def handle_outcome(self, outcome: TaskOutcome) -> None:
+        if self.trace is None:
+            self._handle_outcome(outcome)
+            return
+        self.trace.record_outcome(outcome, self.config.compressor)
+        with self.trace.span("handle_outcome", {"source": outcome.source_rel or outcome.target_rel}):
+            self._handle_outcome(outcome)
+
+    def _handle_outcome(self, outcome: TaskOutcome) -> None:
         self.stats.add(outcome)
+        if self.manifest is not None:
+            self.manifest.record(outcome)
+        if self.journal is not None:
+            self.journal.record(outcome)
+        if self.level_controller is not None:
+            self.level_controller.note_outcome(outcome)
         self.progress.note_outcome(outcome)
         if outcome.action == OutcomeAction.CONVERTED:
             if self.config.dry_run:
@@ -872,9 +3134,10 @@ class Reporter:
                     f"[{outcome.input_format} -> {self.config.compressor}; {outcome.reason}]",
                 )
             else:
+                encoding = f"; {outcome.encoding}" if outcome.encoding else ""
                 self.log_line(
                     f"converted: {outcome.source_rel} -> {outcome.target_rel} "
-                    f"[{human_size(outcome.input_size)} -> {human_size(outcome.output_size)}]",
+                    f"[{human_size(outcome.input_size)} -> {human_size(outcome.output_size)}{encoding}]",
                 )
         elif outcome.action == OutcomeAction.VERIFIED:
             self.vlog_line(
@@ -882,6 +3145,23 @@ class Reporter:
                 f"{outcome.source_rel} -> {outcome.target_rel} [{outcome.reason}]",
             )
         self.progress.render()
+        self.refresh_metrics()
+
+    def refresh_metrics(self) -> None:
+        if self.metrics is not None:
+            self.metrics.refresh()
+
+    def wait_timeout(self) -> Optional[float]:
+        return self.metrics.next_refresh() if self.metrics is not None else None
+
+    def restore_outcome(self, outcome: TaskOutcome) -> None:
+        self.stats.add(outcome)
+        if self.manifest is not None:
+            self.manifest.record(outcome)
+
+    def handle_outcomes(self, outcomes: list[TaskOutcome]) -> None:
+        for outcome in outcomes:
+            self.handle_outcome(outcome)
 
     def render_status_row(self, status: str, bucket: StatsBucket, show_input: bool) -> None:
         print_table_row(
@@ -904,42 +3184,121 @@ class Reporter:
                 print_table_border()
             self.render_status_row(status, bucket, show_input)
         print_table_border()
+        if self.config.manifest and not self.config.delete_extra:
+            print("Retained: not counted, the target tree is not scanned with --manifest unless --delete is given")
+        if self.stats.encodings:
+            print()
+            for encoding, files in sorted(self.stats.encodings.items()):
+                print(f"{encoding}: {files} files")
+        self.print_stage_summary()
+
+    def print_stage_summary(self) -> None:
+        stages = self.stats.stages.totals
+        if not stages:
+            return
+        print()
+        print_table_border()
+        print_table_row("Stage", "Count", "Wall", "CPU", "Wall per item")
+        print_table_border()
+        for stage in STAGE_ORDER:
+            if stage in stages:
+                count, wall, cpu = stages[stage]
+                print_table_row(stage, str(int(count)), format_seconds(wall), format_seconds(cpu), format_seconds(wall / count) if count else "-")
+        print_table_border()
+        rates = [(f"decompress {codec_name}", entry) for codec_name, entry in sorted(self.stats.decoded.items())]
+        if self.stats.encoded[0]:
+            rates.append((f"compress {self.config.compressor}", self.stats.encoded))
+        if not rates:
+            return
+        print_table_row("Codec", "Files", "In per CPU s", "Out per CPU s", "CPU")
+        print_table_border()
+        for label, (files, bytes_in, bytes_out, cpu) in rates:
+            print_table_row(label, str(int(files)), format_rate(bytes_in, cpu), format_rate(bytes_out, cpu), format_seconds(cpu))
+        print_table_border()
 
 
-def iter_file_entries_lex(root: str, rel_root: str = "") -> Iterator[tuple[os.DirEntry[str], str]]:
+def scan_directory(path: str) -> tuple[list[os.DirEntry[str]], list[os.DirEntry[str]]]:
     dirs: list[os.DirEntry[str]] = []
     files: list[os.DirEntry[str]] = []
-    with os.scandir(root) as entries:
+    with os.scandir(path) as entries:
         for entry in entries:
             if entry.is_dir(follow_symlinks=False):
                 dirs.append(entry)
             else:
+                entry.stat(follow_symlinks=False)
                 files.append(entry)
     dirs.sort(key=lambda entry: entry.name)
     files.sort(key=lambda entry: entry.name)
+    return dirs, files
+
+
+def child_rel_path(rel_root: str, name: str) -> str:
+    return os.path.join(rel_root, name) if rel_root else name
+
+
+def iter_file_entries_lex(root: str, rel_root: str = "", scan_jobs: int = 1) -> Iterator[tuple[os.DirEntry[str], str]]:
+    if scan_jobs > 1:
+        yield from iter_file_entries_parallel(root, rel_root, scan_jobs)
+        return
+    dirs, files = scan_directory(root)
     for file_entry in files:
-        rel_path = os.path.join(rel_root, file_entry.name) if rel_root else file_entry.name
-        yield file_entry, rel_path
+        yield file_entry, child_rel_path(rel_root, file_entry.name)
     for dir_entry in dirs:
-        child_rel = os.path.join(rel_root, dir_entry.name) if rel_root else dir_entry.name
-        yield from iter_file_entries_lex(dir_entry.path, child_rel)
-
-
-def iter_target_entries_lex(root: str) -> Iterator[TargetSnapshot]:
-    for entry, rel_path in iter_file_entries_lex(root):
-        if entry.is_file(follow_symlinks=False):
-            stat_result = entry.stat(follow_symlinks=False)
-            yield TargetSnapshot(
-                rel_path=rel_path,
-                path=entry.path,
-                size=stat_result.st_size,
-                mode=stat_result.st_mode,
-                mtime_ns=stat_result.st_mtime_ns,
-            )
+        yield from iter_file_entries_lex(dir_entry.path, child_rel_path(rel_root, dir_entry.name))
 
 
-def iter_source_tasks(config: Config) -> Iterator[FileTask]:
-    for entry, rel_path in iter_file_entries_lex(config.source_dir):
+def iter_file_entries_parallel(root: str, rel_root: str, scan_jobs: int) -> Iterator[tuple[os.DirEntry[str], str]]:
+    window = scan_jobs * SCAN_LOOKAHEAD_FACTOR
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=scan_jobs)
+    try:
+        stack = [PendingScan(root, rel_root, executor.submit(scan_directory, root))]
+        while stack:
+            pending = stack.pop()
+            dirs, files = pending.future.result() if pending.future is not None else scan_directory(pending.path)
+            for file_entry in files:
+                yield file_entry, child_rel_path(pending.rel_path, file_entry.name)
+            for dir_entry in reversed(dirs):
+                stack.append(PendingScan(dir_entry.path, child_rel_path(pending.rel_path, dir_entry.name)))
+            for upcoming in stack[-window:]:
+                if upcoming.future is None:
+                    upcoming.future = executor.submit(scan_directory, upcoming.path)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def is_run_state_file(rel_path: str) -> bool:
+    return os.sep not in rel_path and rel_path.startswith((MANIFEST_NAME, JOURNAL_NAME))
+
+
+def target_snapshot(rel_path: str, path: str, stat_result: os.stat_result) -> TargetSnapshot:
+    return TargetSnapshot(
+        rel_path=rel_path,
+        path=path,
+        size=stat_result.st_size,
+        mode=stat_result.st_mode,
+        mtime_ns=stat_result.st_mtime_ns,
+    )
+
+
+def stat_target_snapshot(rel_path: str, path: str) -> Optional[TargetSnapshot]:
+    try:
+        stat_result = os.stat(path, follow_symlinks=False)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return target_snapshot(rel_path, path, stat_result)
+
+
+def iter_target_entries_lex(root: str, scan_jobs: int = 1, rel_root: str = "") -> Iterator[TargetSnapshot]:
+    for entry, rel_path in iter_file_entries_lex(root, rel_root, scan_jobs):
+        if entry.is_file(follow_symlinks=False) and not is_run_state_file(rel_path):
+            yield target_snapshot(rel_path, entry.path, entry.stat(follow_symlinks=False))
+
+
+def iter_source_tasks(config: Config, rel_root: str = "") -> Iterator[FileTask]:
+    root = os.path.join(config.source_dir, rel_root)
+    if rel_root and not os.path.isdir(root):
+        return
+    for entry, rel_path in iter_file_entries_lex(root, rel_root, config.scan_jobs):
         if entry.is_symlink():
             print(f"Skipping symlink: {rel_path}", file=sys.stderr)
             continue
@@ -949,13 +3308,277 @@ def iter_source_tasks(config: Config) -> Iterator[FileTask]:
         yield build_file_task(config, entry.path, rel_path, entry.stat(follow_symlinks=False))
 
 
+class RunManifest:
+    def __init__(self, config: Config, connection: sqlite3.Connection, writable: bool) -> None:
+        self.config = config
+        self.connection = connection
+        self.writable = writable
+        self.compress_opts = shlex.join(config.compress_opts)
+        self.run_id = time.time_ns()
+        self.pending = 0
+
+    def lookup(self, task: FileTask) -> Optional[ManifestEntry]:
+        row = self.connection.execute(
+            "SELECT source_rel, source_size, source_mtime_ns, codec, compress_opts, target_rel, target_size, uncompressed_size, content_hash "
+            "FROM entries WHERE source_rel = ?",
+            (task.source_rel,),
+        ).fetchone()
+        if row is None:
+            return None
+        entry = ManifestEntry(*row)
+        if (entry.source_size, entry.source_mtime_ns, entry.codec, entry.compress_opts, entry.target_rel) != (
+            task.input_size,
+            task.source_mtime_ns,
+            self.config.compressor,
+            self.compress_opts,
+            task.target_rel,
+        ):
+            return None
+        return entry
+
+    def record(self, outcome: TaskOutcome) -> None:
+        if not self.writable or outcome.action not in (OutcomeAction.CONVERTED, OutcomeAction.VERIFIED):
+            return
+        if outcome.input_size is None or outcome.output_size is None or outcome.source_mtime_ns is None:
+            return
+        self.connection.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                outcome.source_rel,
+                outcome.input_size,
+                outcome.source_mtime_ns,
+                self.config.compressor,
+                self.compress_opts,
+                outcome.target_rel,
+                outcome.output_size,
+                outcome.uncompressed_size,
+                outcome.content_hash,
+                self.run_id,
+            ),
+        )
+        self.pending += 1
+        if self.pending >= MANIFEST_COMMIT_INTERVAL:
+            self.connection.commit()
+            self.pending = 0
+
+    def forget(self, rel_path: str) -> None:
+        if self.writable:
+            prefix = f"{rel_path}/" if rel_path else ""
+            self.connection.execute(
+                "DELETE FROM entries WHERE source_rel = ? OR substr(source_rel, 1, ?) = ?",
+                (rel_path, len(prefix), prefix),
+            )
+
+    def forget_missing(self, rel_path: str, present: set[str]) -> None:
+        if self.writable:
+            prefix = f"{rel_path}/" if rel_path else ""
+            rows = self.connection.execute(
+                "SELECT source_rel FROM entries WHERE source_rel = ? OR substr(source_rel, 1, ?) = ?",
+                (rel_path, len(prefix), prefix),
+            ).fetchall()
+            self.connection.executemany(
+                "DELETE FROM entries WHERE source_rel = ?",
+                [(source_rel,) for (source_rel,) in rows if source_rel not in present],
+            )
+
+    def commit(self) -> None:
+        if self.writable:
+            self.connection.commit()
+            self.pending = 0
+
+    def estimate(self) -> Optional[SourceEstimate]:
+        files, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(source_size), 0) FROM entries").fetchone()
+        if not files:
+            return None
+        estimate = SourceEstimate()
+        estimate.files = files
+        estimate.size = size
+        estimate.complete = True
+        return estimate
+
+    def close(self, *, prune: bool) -> None:
+        if self.writable:
+            if prune:
+                self.connection.execute("DELETE FROM entries WHERE run_id != ?", (self.run_id,))
+            self.connection.commit()
+        self.connection.close()
+
+
+def create_manifest_schema(connection: sqlite3.Connection) -> None:
+    (version,) = connection.execute("PRAGMA user_version").fetchone()
+    if version != MANIFEST_SCHEMA_VERSION:
+        connection.execute("DROP TABLE IF EXISTS entries")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS entries ("
+        "source_rel TEXT PRIMARY KEY, "
+        "source_size INTEGER NOT NULL, "
+        "source_mtime_ns INTEGER NOT NULL, "
+        "codec TEXT NOT NULL, "
+        "compress_opts TEXT NOT NULL, "
+        "target_rel TEXT NOT NULL, "
+        "target_size INTEGER NOT NULL, "
+        "uncompressed_size INTEGER, "
+        "content_hash TEXT, "
+        "run_id INTEGER NOT NULL)"
+    )
+    connection.execute(f"PRAGMA user_version = {MANIFEST_SCHEMA_VERSION}")
+    connection.commit()
+
+
+def open_run_manifest(config: Config) -> Optional[RunManifest]:
+    if not config.manifest:
+        return None
+    path = os.path.join(config.target_dir, MANIFEST_NAME)
+    if config.dry_run:
+        if not os.path.isfile(path):
+            return None
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        (version,) = connection.execute("PRAGMA user_version").fetchone()
+        if version != MANIFEST_SCHEMA_VERSION:
+            connection.close()
+            return None
+        return RunManifest(config, connection, writable=False)
+    connection = sqlite3.connect(path)
+    create_manifest_schema(connection)
+    return RunManifest(config, connection, writable=True)
+
+
+class RunJournal:
+    def __init__(self, path: str, fh: Optional[TextIO], completed: dict[str, TaskOutcome], deleted: list[TaskOutcome]) -> None:
+        self.path = path
+        self.fh = fh
+        self.completed = completed
+        self.deleted = deleted
+
+    def resumed_outcome(self, task: FileTask) -> Optional[TaskOutcome]:
+        outcome = self.completed.get(task.source_rel)
+        if outcome is None or (outcome.input_size, outcome.source_mtime_ns, outcome.target_rel) != (
+            task.input_size,
+            task.source_mtime_ns,
+            task.target_rel,
+        ):
+            return None
+        return outcome
+
+    def record(self, outcome: TaskOutcome) -> None:
+        if self.fh is None or outcome.action.value not in JOURNALED_ACTIONS:
+            return
+        self.fh.write(json.dumps({**dataclasses.asdict(outcome), "timings": {}, "trace": []}) + "\n")
+        self.fh.flush()
+
+    def close(self, *, remove: bool) -> None:
+        if self.fh is None:
+            return
+        self.fh.close()
+        if remove:
+            os.unlink(self.path)
+
+
+def journal_header(config: Config) -> dict:
+    return {"compressor": config.compressor, "compress_opts": config.compress_opts, "target_suffix": config.target_suffix}
+
+
+def read_run_journal(path: str, header: dict) -> Optional[tuple[list[TaskOutcome], int]]:
+    try:
+        fh = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    outcomes: list[TaskOutcome] = []
+    with fh:
+        line = fh.readline()
+        try:
+            if not line.endswith(b"\n") or json.loads(line) != header:
+                return None
+        except ValueError:
+            return None
+        offset = len(line)
+        for line in fh:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                outcomes.append(decode_task_outcome(json.loads(line)))
+            except ValueError:
+                break
+            offset += len(line)
+    return outcomes, offset
+
+
+def open_run_journal(config: Config) -> RunJournal:
+    path = os.path.join(config.target_dir, JOURNAL_NAME)
+    journal = read_run_journal(path, journal_header(config)) if config.resume else None
+    outcomes = journal[0] if journal is not None else None
+    completed: dict[str, TaskOutcome] = {}
+    deleted: list[TaskOutcome] = []
+    if outcomes is not None:
+        for outcome in outcomes:
+            if outcome.action == OutcomeAction.DELETED:
+                deleted.append(outcome)
+            else:
+                completed[outcome.source_rel] = outcome
+        log(config, f"resuming: {len(completed)} files already done")
+    elif config.resume:
+        log(config, "resuming: no usable journal, starting from the beginning")
+    if config.dry_run:
+        return RunJournal(path, None, completed, deleted)
+    if journal is not None:
+        os.truncate(path, journal[1])
+        return RunJournal(path, open(path, "a", encoding="utf-8"), completed, deleted)
+    fh = open(path, "w", encoding="utf-8")
+    fh.write(json.dumps(journal_header(config)) + "\n")
+    return RunJournal(path, fh, completed, deleted)
+
+
+def planned_target_names(config: Config, rel_dir: str) -> set[str]:
+    try:
+        with os.scandir(os.path.join(config.source_dir, rel_dir)) as entries:
+            return {target_rel_for(entry.name, config.target_suffix) for entry in entries if entry.is_file(follow_symlinks=False)}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
+def sweep_temp_outputs(config: Config) -> None:
+    planned: dict[str, set[str]] = {}
+    for entry, rel_path in iter_file_entries_lex(config.target_dir, scan_jobs=config.scan_jobs):
+        match = TEMP_OUTPUT_RE.fullmatch(entry.name)
+        if match is None or not entry.is_file(follow_symlinks=False):
+            continue
+        rel_dir = os.path.dirname(rel_path)
+        if rel_dir not in planned:
+            planned[rel_dir] = planned_target_names(config, rel_dir)
+        if match.group(1) not in planned[rel_dir] or entry.name in planned[rel_dir]:
+            continue
+        if config.dry_run:
+            vlog(config, f"would remove orphaned temp file: {rel_path}")
+        else:
+            os.unlink(entry.path)
+            vlog(config, f"removed orphaned temp file: {rel_path}")
+
+
 class TargetReconciler:
-    def __init__(self, config: Config, reporter: Reporter) -> None:
+    def __init__(self, config: Config, reporter: Reporter, rel_root: str = "", *, walk: bool = True) -> None:
         self.config = config
         self.reporter = reporter
-        self._target_iter = iter_target_entries_lex(config.target_dir)
+        self.manifest = reporter.manifest
+        self.journal = reporter.journal
+        self.root = os.path.join(config.target_dir, rel_root)
+        self.rel_root = rel_root
+        self.walk_target = walk and (self.manifest is None or config.delete_extra)
+        if self.walk_target and (not rel_root or os.path.isdir(self.root)):
+            self._target_iter = iter_target_entries_lex(self.root, config.scan_jobs, rel_root)
+        else:
+            self._target_iter = iter(())
         self._current = next(self._target_iter, None)
 
+    def match_task(self, task: FileTask) -> tuple[Optional[TargetSnapshot], Optional[ManifestEntry]]:
+        entry = self.manifest.lookup(task) if self.manifest is not None else None
+        if self.walk_target:
+            target = self.match_source_target(task.target_rel)
+        else:
+            target = stat_target_snapshot(task.target_rel, task.target_path)
+        if entry is not None and (target is None or (target.size, target.mtime_ns) != (entry.target_size, entry.source_mtime_ns)):
+            entry = None
+        return target, entry
+
     def match_source_target(self, target_rel: str) -> Optional[TargetSnapshot]:
         while self._current is not None and self._current.rel_path < target_rel:
             self.reporter.handle_outcome(execute_target_work_item(plan_target_only_work(self.config, self._current), self.config, self.reporter))
@@ -969,110 +3592,578 @@ class TargetReconciler:
     def finish(self) -> None:
         if self.config.delete_extra:
             self.reporter.start_cleanup_phase()
-        while self._current is not None:
-            self.reporter.handle_outcome(execute_target_work_item(plan_target_only_work(self.config, self._current), self.config, self.reporter))
-            self._current = next(self._target_iter, None)
-        if self.config.delete_extra and not self.config.dry_run:
-            remove_empty_directories(self.config.target_dir)
+        with self.reporter.stats.stages.measure("reconcile", count=0):
+            while self._current is not None:
+                self.reporter.handle_outcome(execute_target_work_item(plan_target_only_work(self.config, self._current), self.config, self.reporter))
+                self._current = next(self._target_iter, None)
+        if self.config.delete_extra and not self.config.dry_run and os.path.isdir(self.root):
+            remove_empty_directories(self.root)
+            if self.rel_root:
+                remove_empty_parents(os.path.join(self.root, ""), self.config.target_dir)
 
 
 def iter_planned_file_work(config: Config, tasks: Iterator[FileTask], reconciler: TargetReconciler) -> Iterator[WorkItem]:
-    for task in tasks:
-        yield plan_file_work(task, config, reconciler.match_source_target(task.target_rel))
-
-
-def local_executor_class(config: Config) -> type[concurrent.futures.Executor]:
-    return concurrent.futures.ProcessPoolExecutor if config.compare_bytes else concurrent.futures.ThreadPoolExecutor
-
-
-def remote_parallel_env(config: Config) -> dict[str, str]:
-    env = os.environ.copy()
-    env.update(
-        {
-            "SOURCE_DIR": config.source_dir,
-            "TARGET_DIR": config.target_dir,
-            "COMPRESSOR": config.compressor,
-            "COMPRESS_OPTS": " ".join(config.compress_opts),
-            "TARGET_SUFFIX": config.target_suffix,
-            "HOSTS_FILE": config.hosts_file,
-            "JOBS": str(config.jobs or ""),
-            "DELETE_EXTRA": str(config.delete_extra).lower(),
-            "COMPARE_BYTES": str(config.compare_bytes).lower(),
-            "DRY_RUN": str(config.dry_run).lower(),
-            "VERBOSE": str(config.verbose).lower(),
-            "QUIET": str(config.quiet).lower(),
-        }
+    stages = reconciler.reporter.stats.stages
+    while True:
+        with stages.measure("scan", count=0):
+            task = next(tasks, None)
+        if task is None:
+            return
+        stages.add("scan", 0.0, 0.0)
+        with stages.measure("reconcile"):
+            target, manifest_entry = reconciler.match_task(task)
+        resumed = reconciler.journal.resumed_outcome(task) if reconciler.journal is not None else None
+        if resumed is not None and target is not None:
+            reconciler.reporter.restore_outcome(resumed)
+            continue
+        yield plan_file_work(task, config, target, manifest_entry)
+
+
+def work_item_cost(item: WorkItem) -> int:
+    if item.action == WorkAction.VERIFY_METADATA or item.task is None:
+        return 0
+    return item.task.input_size
+
+
+def iter_work_batches(work_items: Iterator[WorkItem]) -> Iterator[list[WorkItem]]:
+    batch: list[WorkItem] = []
+    batch_bytes = 0
+    for item in work_items:
+        cost = work_item_cost(item)
+        if cost > BATCH_SMALL_FILE_SIZE:
+            if batch:
+                yield batch
+                batch = []
+                batch_bytes = 0
+            yield [item]
+            continue
+        batch.append(item)
+        batch_bytes += cost
+        if len(batch) >= BATCH_MAX_ITEMS or batch_bytes >= BATCH_MAX_BYTES:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+
+def iter_largest_first(work_items: Iterator[WorkItem], window: int) -> Iterator[WorkItem]:
+    heap: list[tuple[int, int, WorkItem]] = []
+    for index, item in enumerate(work_items):
+        heapq.heappush(heap, (-work_item_cost(item), index, item))
+        if len(heap) >= window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def schedule_work_items(config: Config, work_items: Iterator[WorkItem]) -> Iterator[WorkItem]:
+    if config.schedule == "largest-first":
+        return iter_largest_first(work_items, config.lookahead)
+    return work_items
+
+
+def local_executor(config: Config, jobs: int) -> concurrent.futures.Executor:
+    if config.compare_bytes:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=configure_io_governor, initargs=(config, jobs))
+    return concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+
+def iter_governed_work_items(work_items: Iterator[WorkItem], reporter: Reporter) -> Iterator[WorkItem]:
+    for item in work_items:
+        if not IO_GOVERNOR.resumed.is_set():
+            reporter.log_line("paused: send SIGUSR2 to resume")
+            IO_GOVERNOR.resumed.wait()
+            reporter.log_line("resumed")
+        yield item
+
+
+def read_hosts_file(path: str) -> list[WorkerHost]:
+    hosts: list[WorkerHost] = []
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            match = HOST_LINE_RE.fullmatch(line)
+            assert match is not None
+            hosts.append(WorkerHost(login=match.group(2).strip(), slots=int(match.group(1)) if match.group(1) else None))
+    if not hosts:
+        die(f"hosts file lists no hosts: {path}")
+    return hosts
+
+
+def write_frame(stream: BinaryIO, kind: bytes, batch_id: int, payload: bytes) -> None:
+    stream.write(FRAME_HEADER.pack(kind, batch_id, len(payload)))
+    stream.write(payload)
+    stream.flush()
+
+
+def read_frame(stream: BinaryIO) -> Optional[tuple[bytes, int, bytes]]:
+    header = stream.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) != FRAME_HEADER.size:
+        raise EOFError("truncated worker frame header")
+    kind, batch_id, length = FRAME_HEADER.unpack(header)
+    payload = stream.read(length)
+    if len(payload) != length:
+        raise EOFError("truncated worker frame payload")
+    return kind, batch_id, payload
+
+
+def encode_json(value: object) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def decode_work_item(data: dict) -> WorkItem:
+    return WorkItem(
+        action=WorkAction(data["action"]),
+        reason=data["reason"],
+        task=FileTask(**data["task"]) if data["task"] is not None else None,
+        target=TargetSnapshot(**data["target"]) if data["target"] is not None else None,
+        manifest=ManifestEntry(**data["manifest"]) if data["manifest"] is not None else None,
+        level_policy=LevelPolicy(**data["level_policy"]) if data["level_policy"] is not None else None,
     )
-    return env
-
-
-def open_remote_parallel(config: Config) -> subprocess.Popen[bytes]:
-    if shutil.which("parallel") is None:
-        die("--hosts-file requires GNU parallel to be installed")
-    version = subprocess.run(["parallel", "--version"], capture_output=True, text=True)
-    if version.returncode != 0:
-        die("--hosts-file requires GNU parallel; found a different 'parallel' implementation")
-    cmd = ["parallel", "--will-cite", "-0", "--sshloginfile", config.hosts_file]
-    if config.jobs:
-        cmd += ["--jobs", str(config.jobs)]
-    cmd += ["--", SCRIPT_PATH, "--internal-convert", "{}"]
-    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, env=remote_parallel_env(config))
-    assert proc.stdin is not None
-    return proc
 
 
-def run_remote_parallel(config: Config, work_items: Iterator[WorkItem], reporter: Reporter) -> None:
-    proc: Optional[subprocess.Popen[bytes]] = None
+def decode_task_outcome(data: dict) -> TaskOutcome:
+    return TaskOutcome(**{**data, "action": OutcomeAction(data["action"])})
+
+
+class WorkerChannel:
+    def __init__(self, stream: BinaryIO) -> None:
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def send(self, kind: bytes, batch_id: int, payload: bytes) -> None:
+        with self.lock:
+            write_frame(self.stream, kind, batch_id, payload)
+
+    def reply(self, batch_id: int, future: concurrent.futures.Future[list[TaskOutcome]]) -> None:
+        error = future.exception()
+        if error is not None:
+            self.send(FRAME_ERROR, batch_id, f"{type(error).__name__}: {error}".encode())
+            return
+        self.send(FRAME_OUTCOMES, batch_id, encode_json([dataclasses.asdict(outcome) for outcome in future.result()]))
+
+    def finish(self, batch_id: int, future: concurrent.futures.Future[dict]) -> None:
+        error = future.exception()
+        if error is not None:
+            self.send(FRAME_ERROR, batch_id, f"{type(error).__name__}: {error}".encode())
+            return
+        self.send(FRAME_FINISHED, batch_id, encode_json(future.result()))
+
+    def send_stream(self, batch_id: int, fh: BinaryIO) -> None:
+        with fh:
+            while chunk := fh.read(CHUNK_SIZE):
+                self.send(FRAME_DATA, batch_id, chunk)
+
+
+def convert_streamed_input(channel: WorkerChannel, batch_id: int, source: BinaryIO, item: WorkItem, config: Config) -> dict:
+    with STAGE_CLOCK.collect(StageTimings(trace_enabled(config))) as timings, STAGE_CLOCK.span("convert"):
+        result = compress_streamed_input(channel, batch_id, source, item, config)
+    return {**result, "timings": timings.totals, "trace": timings.trace_payload()}
+
+
+def compress_streamed_input(channel: WorkerChannel, batch_id: int, source: BinaryIO, item: WorkItem, config: Config) -> dict:
+    assert item.task is not None
+    hasher = new_content_hasher() if config.manifest else None
+    reader = open_decompressed_pipe(source, item.task.input_format, config.in_process)
     try:
-        for item in work_items:
-            if item.action == WorkAction.CONVERT:
-                assert item.task is not None
-                if config.dry_run:
-                    reporter.handle_outcome(execute_convert_work_item(item, config))
+        compress_opts, encoding = choose_compress_opts(reader, item.task, config, item.level_policy)
+        read_fd, write_fd = os.pipe()
+        enlarge_pipe(write_fd)
+        out_fh = open(write_fd, "wb")
+        sender = threading.Thread(target=channel.send_stream, args=(batch_id, open(read_fd, "rb")))
+        sender.start()
+        try:
+            with out_fh:
+                uncompressed_size = compress_to_file(
+                    reader,
+                    out_fh,
+                    config.compressor,
+                    compress_opts,
+                    config.in_process,
+                    hasher,
+                    block_settings(item.task, config),
+                )
+        finally:
+            sender.join()
+    finally:
+        reader.close()
+    return {
+        "uncompressed_size": uncompressed_size,
+        "content_hash": hasher.hexdigest() if hasher is not None else None,
+        "encoding": encoding,
+    }
+
+
+class StreamedInput:
+    def __init__(self, sink: BinaryIO) -> None:
+        self.chunks: queue.SimpleQueue[bytes] = queue.SimpleQueue()
+        self.feeder = threading.Thread(target=self._drain, args=(sink,), daemon=True)
+        self.feeder.start()
+
+    def feed(self, payload: bytes) -> None:
+        self.chunks.put(payload)
+
+    def _drain(self, sink: BinaryIO) -> None:
+        with sink:
+            try:
+                while chunk := self.chunks.get():
+                    sink.write(chunk)
+                return
+            except BrokenPipeError:
+                pass
+        while self.chunks.get():
+            pass
+
+
+def feed_streamed_input(inputs: dict[int, StreamedInput], batch_id: int, payload: bytes) -> None:
+    stream = inputs.get(batch_id)
+    if stream is None:
+        return
+    stream.feed(payload)
+    if not payload:
+        del inputs[batch_id]
+
+
+def run_worker() -> int:
+    channel = WorkerChannel(os.fdopen(os.dup(sys.stdout.fileno()), "wb"))
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    requests = sys.stdin.buffer
+    frame = read_frame(requests)
+    if frame is None:
+        return 0
+    if frame[0] != FRAME_CONFIG:
+        die("worker expected a configuration frame")
+    config = Config(**json.loads(frame[2]))
+    jobs = config.jobs or default_local_jobs()
+    config = dataclasses.replace(config, jobs=jobs, max_threads=default_local_jobs(), max_memory=default_memory_budget())
+    channel.send(FRAME_READY, 0, encode_json({"jobs": jobs, "max_threads": config.max_threads, "max_memory": config.max_memory}))
+    apply_process_priority(config)
+    configure_io_governor(config)
+    streaming = config.remote_transport == "stream"
+    inputs: dict[int, StreamedInput] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) if streaming else local_executor(config, jobs) as executor:
+        while (frame := read_frame(requests)) is not None:
+            kind, batch_id, payload = frame
+            if kind == FRAME_BATCH:
+                items = [decode_work_item(item) for item in json.loads(payload)]
+                executor.submit(execute_work_batch, items, config).add_done_callback(functools.partial(channel.reply, batch_id))
+            elif kind == FRAME_STREAM:
+                read_fd, write_fd = os.pipe()
+                enlarge_pipe(write_fd)
+                inputs[batch_id] = StreamedInput(open(write_fd, "wb", buffering=0))
+                item = decode_work_item(json.loads(payload))
+                future = executor.submit(convert_streamed_input, channel, batch_id, open(read_fd, "rb"), item, config)
+                future.add_done_callback(functools.partial(channel.finish, batch_id))
+            elif kind == FRAME_DATA:
+                feed_streamed_input(inputs, batch_id, payload)
+            else:
+                die(f"worker received an unexpected frame: {kind!r}")
+    channel.stream.close()
+    return 0
+
+
+class RemoteWorker:
+    def __init__(self, host: WorkerHost, config: Config, events: queue.Queue[tuple[RemoteWorker, Optional[tuple[bytes, int, bytes]]]]) -> None:
+        self.host = host
+        self.config = config
+        try:
+            self.proc = subprocess.Popen(host.command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError as exc:
+            die(f"cannot start worker on {host.login}: {exc}")
+        assert self.proc.stdin is not None and self.proc.stdout is not None
+        self.channel = WorkerChannel(self.proc.stdin)
+        self.events = events
+        self.streaming = config.remote_transport == "stream"
+        self.jobs = 0
+        self.capacity = 0
+        self.admission = AdmissionController(0, 0)
+        self.in_flight: dict[int, ResourceCost] = {}
+        self.streams: dict[int, StreamedOutput] = {}
+        self.channel.send(FRAME_CONFIG, 0, encode_json(dataclasses.asdict(dataclasses.replace(config, jobs=host.slots or config.jobs))))
+        self.reader = threading.Thread(target=self._forward_frames, args=(self.proc.stdout,), daemon=True)
+        self.reader.start()
+
+    def _forward_frames(self, stream: BinaryIO) -> None:
+        try:
+            while (frame := read_frame(stream)) is not None:
+                if frame[0] == FRAME_DATA:
+                    self.streams[frame[1]].fh.write(frame[2])
                 else:
-                    if proc is None:
-                        proc = open_remote_parallel(config)
-                    assert proc.stdin is not None
-                    proc.stdin.write(item.task.source_path.encode() + b"\0")
-                continue
+                    self.events.put((self, frame))
+        except (OSError, EOFError) as exc:
+            self.events.put((self, (FRAME_ERROR, 0, f"{type(exc).__name__}: {exc}".encode())))
+        self.events.put((self, None))
+
+    def _feed_source(self, batch_id: int, source_path: str) -> None:
+        try:
+            with IO_GOVERNOR.reader(open(source_path, "rb")) as fh:
+                while chunk := fh.read(CHUNK_SIZE):
+                    self.channel.send(FRAME_DATA, batch_id, chunk)
+            self.channel.send(FRAME_DATA, batch_id, b"")
+        except OSError as exc:
+            self.events.put((self, (FRAME_ERROR, batch_id, f"{type(exc).__name__}: {exc}".encode())))
+
+    def mark_ready(self, ready: dict) -> None:
+        self.jobs = ready["jobs"]
+        self.config = dataclasses.replace(self.config, jobs=self.jobs, max_threads=ready["max_threads"])
+        self.capacity = self.jobs if self.streaming else self.jobs * 2
+        self.admission = AdmissionController(ready["max_threads"], ready["max_memory"])
+
+    def load(self) -> float:
+        return len(self.in_flight) / self.jobs if self.jobs else float("inf")
+
+    def reserve(self, batch_id: int, cost: ResourceCost) -> bool:
+        if len(self.in_flight) >= self.capacity or not self.admission.try_acquire(cost):
+            return False
+        self.in_flight[batch_id] = cost
+        return True
+
+    def try_send(self, batch_id: int, batch: list[WorkItem], conversion_cost: ResourceCost) -> bool:
+        if not self.reserve(batch_id, batch_resource_cost(batch, conversion_cost, self.config)):
+            return False
+        self.channel.send(FRAME_BATCH, batch_id, encode_json([dataclasses.asdict(item) for item in batch]))
+        return True
+
+    def try_stream(self, batch_id: int, item: WorkItem, conversion_cost: ResourceCost) -> bool:
+        assert item.task is not None
+        task = item.task
+        if not self.reserve(batch_id, batch_resource_cost([item], conversion_cost, self.config)):
+            return False
+        tmp_path = create_temp_output(task.target_path)
+        self.streams[batch_id] = StreamedOutput(task, tmp_path, IO_GOVERNOR.writer(open(tmp_path, "wb")))
+        self.channel.send(FRAME_STREAM, batch_id, encode_json(dataclasses.asdict(item)))
+        threading.Thread(target=self._feed_source, args=(batch_id, task.source_path), daemon=True).start()
+        return True
+
+    def complete(self, batch_id: int) -> None:
+        self.admission.release(self.in_flight.pop(batch_id))
+
+    def finish_stream(self, batch_id: int, result: dict) -> TaskOutcome:
+        output = self.streams.pop(batch_id)
+        output.fh.close()
+        task = output.task
+        with STAGE_CLOCK.collect(StageTimings(bool(result["trace"]))) as timings:
+            output_size = finalize_temp_output(output.tmp_path, task.target_path)
+            with STAGE_CLOCK.measure("copystat"):
+                shutil.copystat(task.source_path, task.target_path, follow_symlinks=False)
+        timings.merge(result["timings"])
+        return TaskOutcome(
+            action=OutcomeAction.CONVERTED,
+            source_rel=task.source_rel,
+            target_rel=task.target_rel,
+            input_format=task.input_format,
+            input_size=task.input_size,
+            output_size=output_size,
+            uncompressed_size=result["uncompressed_size"],
+            source_mtime_ns=task.source_mtime_ns,
+            content_hash=result["content_hash"],
+            encoding=result["encoding"],
+            timings=timings.totals,
+            trace=[*result["trace"], *timings.trace_payload()],
+        )
+
+    def discard_streams(self) -> None:
+        for output in self.streams.values():
+            output.fh.close()
+            discard_temp_output(output.tmp_path)
+        self.streams.clear()
+
+
+class RemoteDispatcher:
+    def __init__(self, config: Config, reporter: Reporter, hosts: list[WorkerHost]) -> None:
+        self.config = config
+        self.reporter = reporter
+        self.hosts = hosts
+        self.conversion_cost = estimate_codec_resources(config.compressor, conversion_cost_opts(config))
+        self.events: queue.Queue[tuple[RemoteWorker, Optional[tuple[bytes, int, bytes]]]] = queue.Queue()
+        self.workers: list[RemoteWorker] = []
+        self.next_batch_id = 0
+        self.window = InFlightWindow(config, effective_job_count(config))
+        self.window_sizes: dict[int, tuple[int, int]] = {}
+        reporter.progress.window = self.window
+
+    def submit(self, batch: list[WorkItem]) -> None:
+        self.place(batch, lambda worker, batch_id: worker.try_send(batch_id, batch, self.conversion_cost))
+
+    def submit_stream(self, item: WorkItem) -> None:
+        self.place([item], lambda worker, batch_id: worker.try_stream(batch_id, item, self.conversion_cost))
+
+    def place(self, items: list[WorkItem], send: Callable[[RemoteWorker, int], bool]) -> None:
+        if not self.workers:
+            self.workers = [RemoteWorker(host, self.config, self.events) for host in self.hosts]
+        self.next_batch_id += 1
+        while True:
+            for worker in sorted(self.workers, key=RemoteWorker.load):
+                if send(worker, self.next_batch_id):
+                    self.window_sizes[self.next_batch_id] = (len(items), self.window.add(items))
+                    return
+            self.wait_one()
+
+    def wait_one(self) -> None:
+        while True:
+            try:
+                with self.reporter.span("wait"):
+                    worker, frame = self.events.get(timeout=self.reporter.wait_timeout())
+                break
+            except queue.Empty:
+                self.reporter.refresh_metrics()
+        if frame is None:
+            die(f"worker on {worker.host.login} exited unexpectedly")
+        kind, batch_id, payload = frame
+        if kind == FRAME_READY:
+            worker.mark_ready(json.loads(payload))
+        elif kind == FRAME_OUTCOMES:
+            worker.complete(batch_id)
+            self.window.remove(*self.window_sizes.pop(batch_id))
+            self.reporter.handle_outcomes([decode_task_outcome(outcome) for outcome in json.loads(payload)])
+        elif kind == FRAME_FINISHED:
+            worker.complete(batch_id)
+            self.window.remove(*self.window_sizes.pop(batch_id))
+            self.reporter.handle_outcome(worker.finish_stream(batch_id, json.loads(payload)))
+        elif kind == FRAME_ERROR:
+            die(f"worker on {worker.host.login} failed: {payload.decode(errors='replace')}")
+        else:
+            die(f"worker on {worker.host.login} sent an unexpected frame: {kind!r}")
+
+    def drain(self) -> None:
+        while any(worker.in_flight for worker in self.workers):
+            self.wait_one()
+
+    def close(self) -> None:
+        for worker in self.workers:
+            assert worker.proc.stdin is not None
+            worker.proc.stdin.close()
+        for worker in self.workers:
+            if worker.proc.wait() != 0:
+                die(f"worker on {worker.host.login} exited with status {worker.proc.returncode}")
+
+    def abort(self) -> None:
+        for worker in self.workers:
+            worker.proc.kill()
+            worker.proc.wait()
+            worker.discard_streams()
+
+
+def run_remote(
+    config: Config,
+    work_items: Iterator[WorkItem],
+    reporter: Reporter,
+    dispatcher: Optional[RemoteDispatcher] = None,
+) -> None:
+    persistent = dispatcher is not None
+    if dispatcher is None:
+        dispatcher = RemoteDispatcher(config, reporter, read_hosts_file(config.hosts_file))
+    try:
+        if config.remote_transport == "stream":
+            for item in iter_streamed_work_items(work_items, config, reporter):
+                dispatcher.submit_stream(item)
+                while dispatcher.window.full():
+                    dispatcher.wait_one()
+        else:
+            for batch in iter_work_batches(iter_remote_work_items(work_items, config, reporter)):
+                dispatcher.submit(batch)
+                while dispatcher.window.full():
+                    dispatcher.wait_one()
+        dispatcher.drain()
+    except BaseException:
+        dispatcher.abort()
+        raise
+    if not persistent:
+        dispatcher.close()
+
+
+def iter_remote_work_items(work_items: Iterator[WorkItem], config: Config, reporter: Reporter) -> Iterator[WorkItem]:
+    for item in work_items:
+        if item.action == WorkAction.VERIFY_METADATA:
+            reporter.handle_outcome(execute_work_item(item, config))
+        else:
+            yield item
+
+
+def iter_streamed_work_items(work_items: Iterator[WorkItem], config: Config, reporter: Reporter) -> Iterator[WorkItem]:
+    for item in work_items:
+        if item.action != WorkAction.CONVERT:
             resolved = resolve_verification_work_item(item, config)
             if isinstance(resolved, TaskOutcome):
                 reporter.handle_outcome(resolved)
                 continue
-            assert resolved.task is not None
-            if config.dry_run:
-                reporter.handle_outcome(execute_convert_work_item(resolved, config))
-            else:
-                if proc is None:
-                    proc = open_remote_parallel(config)
-                assert proc.stdin is not None
-                proc.stdin.write(resolved.task.source_path.encode() + b"\0")
-    finally:
-        if proc is not None and proc.stdin is not None:
-            proc.stdin.close()
-    if proc is not None and proc.wait() != 0:
-        raise subprocess.CalledProcessError(proc.returncode or 1, proc.args)
+            item = dataclasses.replace(resolved, level_policy=item.level_policy)
+        assert item.task is not None
+        if config.dry_run or (config.passthrough != "off" and item.task.input_format == config.compressor):
+            reporter.handle_outcome(execute_convert_work_item(item, config))
+        else:
+            yield item
 
 
-def run_local(config: Config, work_items: Iterator[WorkItem], reporter: Reporter) -> None:
+def run_local(
+    config: Config,
+    work_items: Iterator[WorkItem],
+    reporter: Reporter,
+    dispatcher: Optional[LocalDispatcher] = None,
+) -> None:
+    if dispatcher is not None:
+        dispatch_local(dispatcher, work_items)
+        return
     jobs = config.jobs or default_local_jobs()
     if jobs <= 1:
         for item in work_items:
             reporter.handle_outcome(execute_work_item(item, config))
         return
-    max_pending = max(jobs * 2, 1)
-    with local_executor_class(config)(max_workers=jobs) as executor:
-        pending: set[concurrent.futures.Future[TaskOutcome]] = set()
-        for item in work_items:
-            pending.add(executor.submit(execute_work_item, item, config))
-            if len(pending) >= max_pending:
-                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
-                for future in done:
-                    reporter.handle_outcome(future.result())
-        while pending:
-            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
-            for future in done:
-                reporter.handle_outcome(future.result())
+    with local_executor(config, jobs) as executor:
+        dispatch_local(LocalDispatcher(config, reporter, executor, InFlightWindow(config, jobs)), work_items)
+
+
+def dispatch_local(dispatcher: LocalDispatcher, work_items: Iterator[WorkItem]) -> None:
+    for batch in iter_work_batches(work_items):
+        dispatcher.submit(batch)
+        while dispatcher.window.full():
+            dispatcher.wait_one()
+    dispatcher.drain()
+
+
+class LocalDispatcher:
+    def __init__(self, config: Config, reporter: Reporter, executor: concurrent.futures.Executor, window: InFlightWindow) -> None:
+        self.config = config
+        self.reporter = reporter
+        self.executor = executor
+        self.window = window
+        self.admission = AdmissionController(config.max_threads, config.max_memory)
+        self.conversion_cost = estimate_codec_resources(config.compressor, conversion_cost_opts(config))
+        self.pending: dict[concurrent.futures.Future[list[TaskOutcome]], tuple[ResourceCost, int, int]] = {}
+        reporter.progress.window = window
+
+    def submit(self, batch: list[WorkItem]) -> None:
+        cost = batch_resource_cost(batch, self.conversion_cost, self.config)
+        while not self.admission.try_acquire(cost):
+            self.wait_one()
+        size = self.window.add(batch)
+        self.pending[self.executor.submit(execute_work_batch, batch, self.config)] = (cost, len(batch), size)
+
+    def wait_one(self) -> None:
+        while True:
+            with self.reporter.span("wait"):
+                done, _ = concurrent.futures.wait(
+                    self.pending,
+                    timeout=self.reporter.wait_timeout(),
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+            if done:
+                break
+            self.reporter.refresh_metrics()
+        for future in done:
+            cost, files, size = self.pending.pop(future)
+            self.admission.release(cost)
+            self.window.remove(files, size)
+            self.reporter.handle_outcomes(future.result())
+
+    def drain(self) -> None:
+        while self.pending:
+            self.wait_one()
 
 
 def remove_empty_directories(root: str) -> None:
@@ -1089,45 +4180,359 @@ def remove_empty_directories(root: str) -> None:
             pass
 
 
-def run_internal_convert(config: Config, source_file: str) -> None:
-    task = build_internal_task(config, source_file)
-    result = execute_convert_work_item(WorkItem(action=WorkAction.CONVERT, reason="remote conversion", task=task), config)
-    if result.action == OutcomeAction.CONVERTED and not config.dry_run:
-        log(config, f"converted: {result.source_rel} -> {result.target_rel} [{human_size(result.input_size)} -> {human_size(result.output_size)}]")
+def remove_empty_parents(path: str, root: str) -> None:
+    parent = os.path.dirname(path)
+    while parent.startswith(os.path.join(root, "")):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            return
+        parent = os.path.dirname(parent)
 
 
 def traverse_source(config: Config) -> Iterator[FileTask]:
     return iter_source_tasks(config)
 
 
-def execute_tasks(config: Config, source_tasks: Iterator[FileTask], stats: StatsAccumulator) -> TargetReconciler:
-    reporter = Reporter(config, stats)
+def execute_tasks(
+    config: Config,
+    source_tasks: Iterator[FileTask],
+    stats: StatsAccumulator,
+    metrics: Optional[MetricsExporter] = None,
+) -> TargetReconciler:
+    if config.resume:
+        sweep_temp_outputs(config)
+    journal = open_run_journal(config)
+    level_controller = LevelController(config, effective_job_count(config)) if config.target_throughput else None
+    reporter = Reporter(config, stats, open_run_manifest(config), journal, level_controller, open_run_trace(config), metrics)
+    if reporter.progress.enabled:
+        reporter.progress.estimate = start_source_estimate(config, reporter.manifest)
+    for outcome in journal.deleted:
+        reporter.restore_outcome(outcome)
     reconciler = TargetReconciler(config, reporter)
-    work_items = iter_planned_file_work(config, source_tasks, reconciler)
-    if config.hosts_file:
-        run_remote_parallel(config, work_items, reporter)
-    else:
-        run_local(config, work_items, reporter)
+    run_work_items(config, iter_planned_file_work(config, source_tasks, reconciler), reporter)
     return reconciler
 
 
+def run_work_items(
+    config: Config,
+    work_items: Iterator[WorkItem],
+    reporter: Reporter,
+    dispatcher: Optional[LocalDispatcher | RemoteDispatcher] = None,
+) -> None:
+    work_items = schedule_work_items(config, work_items)
+    if reporter.level_controller is not None:
+        work_items = reporter.level_controller.stamp(work_items)
+    work_items = iter_governed_work_items(work_items, reporter)
+    if isinstance(dispatcher, RemoteDispatcher) or (dispatcher is None and config.hosts_file):
+        run_remote(config, work_items, reporter, dispatcher)
+    else:
+        run_local(config, work_items, reporter, dispatcher)
+
+
+def open_watch_dispatcher(config: Config, reporter: Reporter, stack: contextlib.ExitStack) -> Optional[LocalDispatcher | RemoteDispatcher]:
+    if config.hosts_file:
+        dispatcher = RemoteDispatcher(config, reporter, read_hosts_file(config.hosts_file))
+        stack.callback(dispatcher.abort)
+        return dispatcher
+    jobs = config.jobs or default_local_jobs()
+    if jobs <= 1:
+        return None
+    executor = stack.enter_context(local_executor(config, jobs))
+    return LocalDispatcher(config, reporter, executor, InFlightWindow(config, jobs))
+
+
 def reconcile_target(reconciler: TargetReconciler) -> None:
     reconciler.finish()
     reconciler.reporter.finish_output()
+    if reconciler.journal is not None:
+        reconciler.journal.close(remove=True)
+        reconciler.reporter.journal = None
+    if not reconciler.config.watch:
+        close_run_state(reconciler.reporter)
+    elif reconciler.reporter.manifest is not None:
+        reconciler.reporter.manifest.commit()
+
+
+def close_run_state(reporter: Reporter) -> None:
+    if reporter.manifest is not None:
+        reporter.manifest.close(prune=True)
+    if reporter.trace is not None:
+        reporter.trace.close()
+
+
+class InotifyWatcher:
+    kind = "inotify"
+    settle = 0.0
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths: dict[int, str] = {}
+        self.watches: dict[str, int] = {}
+        try:
+            self.add_tree("")
+        except BaseException:
+            self.close()
+            raise
+
+    def add_watch(self, rel_path: str) -> bool:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.root, rel_path)), INOTIFY_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise OSError(err, os.strerror(err), os.path.join(self.root, rel_path))
+        self.paths[wd] = rel_path
+        self.watches[rel_path] = wd
+        return True
+
+    def add_tree(self, rel_path: str) -> None:
+        if not self.add_watch(rel_path):
+            return
+        try:
+            dirs, _ = scan_directory(os.path.join(self.root, rel_path))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for dir_entry in dirs:
+            self.add_tree(child_rel_path(rel_path, dir_entry.name))
+
+    def remove_tree(self, rel_path: str) -> None:
+        prefix = f"{rel_path}/"
+        for path in [path for path in self.watches if path == rel_path or path.startswith(prefix)]:
+            wd = self.watches.pop(path)
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def poll(self, timeout: float) -> list[tuple[str, bool]]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        changes: list[tuple[str, bool]] = []
+        while readable:
+            try:
+                data = os.read(self.fd, INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                break
+            changes += self.parse_events(data)
+        return changes
+
+    def parse_events(self, data: bytes) -> list[tuple[str, bool]]:
+        changes: list[tuple[str, bool]] = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changes.append(("", True))
+                continue
+            if mask & IN_IGNORED:
+                path = self.paths.pop(wd, None)
+                if path is not None and self.watches.get(path) == wd:
+                    del self.watches[path]
+                continue
+            parent = self.paths.get(wd)
+            if parent is None or not name:
+                continue
+            rel_path = child_rel_path(parent, name)
+            is_dir = bool(mask & IN_ISDIR)
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(rel_path)
+            elif is_dir and mask & (IN_DELETE | IN_MOVED_FROM):
+                self.remove_tree(rel_path)
+            changes.append((rel_path, is_dir))
+        return changes
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    kind = "polling"
+
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.settle = config.watch_interval
+        self.snapshot = self.scan() or {}
+        self.next_scan = time.monotonic() + config.watch_interval
+
+    def scan(self) -> Optional[dict[str, tuple[int, int, int]]]:
+        snapshot: dict[str, tuple[int, int, int]] = {}
+        try:
+            for entry, rel_path in iter_file_entries_lex(self.config.source_dir, scan_jobs=self.config.scan_jobs):
+                stat_result = entry.stat(follow_symlinks=False)
+                snapshot[rel_path] = (stat_result.st_mode, stat_result.st_size, stat_result.st_mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return snapshot
+
+    def poll(self, timeout: float) -> list[tuple[str, bool]]:
+        delay = self.next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(delay, 0))
+        self.next_scan = time.monotonic() + self.config.watch_interval
+        snapshot = self.scan()
+        if snapshot is None:
+            return []
+        previous = self.snapshot
+        self.snapshot = snapshot
+        changed = [rel_path for rel_path, state in snapshot.items() if previous.get(rel_path) != state]
+        changed += [rel_path for rel_path in previous if rel_path not in snapshot]
+        return [(rel_path, False) for rel_path in changed]
+
+    def close(self) -> None:
+        pass
+
+
+def open_source_watcher(config: Config) -> InotifyWatcher | PollingWatcher:
+    try:
+        return InotifyWatcher(config.source_dir)
+    except (AttributeError, OSError) as exc:
+        log(config, f"inotify unavailable ({exc}); polling the source tree every {config.watch_interval:g} s")
+        return PollingWatcher(config)
+
+
+def raise_keyboard_interrupt(signum: int, frame: object) -> None:
+    raise KeyboardInterrupt
+
+
+def watch_source(config: Config, reporter: Reporter, watcher: InotifyWatcher | PollingWatcher) -> None:
+    signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+    reporter.log_line(f"watching {config.source_dir} ({watcher.kind}); press Ctrl-C to stop")
+    debounce = max(config.watch_debounce, watcher.settle)
+    pending: dict[str, tuple[float, bool]] = {}
+    stack = contextlib.ExitStack()
+    try:
+        dispatcher = open_watch_dispatcher(config, reporter, stack)
+        while True:
+            now = time.monotonic()
+            timeout = min((stamp + debounce - now for stamp, _ in pending.values()), default=1.0)
+            for rel_path, is_dir in watcher.poll(min(max(timeout, 0.0), 1.0)):
+                pending[rel_path] = (time.monotonic(), is_dir or pending.get(rel_path, (0.0, False))[1])
+            now = time.monotonic()
+            ready = [(rel_path, is_dir) for rel_path, (stamp, is_dir) in pending.items() if now - stamp >= debounce]
+            for rel_path, _ in ready:
+                del pending[rel_path]
+            if ready:
+                apply_source_changes(config, reporter, ready, dispatcher)
+            reporter.refresh_metrics()
+    except KeyboardInterrupt:
+        reporter.finish_output()
+    finally:
+        stack.close()
+        watcher.close()
+        close_run_state(reporter)
+
+
+def apply_source_changes(
+    config: Config,
+    reporter: Reporter,
+    changes: list[tuple[str, bool]],
+    dispatcher: Optional[LocalDispatcher | RemoteDispatcher] = None,
+) -> None:
+    dirs = {rel_path for rel_path, is_dir in changes if is_dir or is_real_directory(os.path.join(config.source_dir, rel_path))}
+    if "" in dirs:
+        dirs = {""}
+    dirs = {rel_path for rel_path in dirs if not has_changed_ancestor(rel_path, dirs)}
+    for rel_path in sorted(dirs):
+        present: set[str] = set()
+        reconciler = TargetReconciler(config, reporter, rel_path)
+        source_tasks = iter_recorded_source_tasks(iter_source_tasks(config, rel_path), present)
+        run_work_items(config, iter_planned_file_work(config, source_tasks, reconciler), reporter, dispatcher)
+        reconciler.finish()
+        if reporter.manifest is not None:
+            reporter.manifest.forget_missing(rel_path, present)
+    files = sorted(rel_path for rel_path, _ in changes if rel_path not in dirs and not has_changed_ancestor(rel_path, dirs))
+    if files:
+        reconciler = TargetReconciler(config, reporter, walk=False)
+        source_tasks = iter_changed_source_tasks(config, reporter, files)
+        run_work_items(config, iter_planned_file_work(config, source_tasks, reconciler), reporter, dispatcher)
+    if reporter.manifest is not None:
+        reporter.manifest.commit()
+    reporter.finish_output()
+
+
+def iter_recorded_source_tasks(source_tasks: Iterator[FileTask], present: set[str]) -> Iterator[FileTask]:
+    for task in source_tasks:
+        present.add(task.source_rel)
+        yield task
+
+
+def is_real_directory(path: str) -> bool:
+    try:
+        return stat.S_ISDIR(os.stat(path, follow_symlinks=False).st_mode)
+    except OSError:
+        return False
+
+
+def has_changed_ancestor(rel_path: str, dirs: set[str]) -> bool:
+    if "" in dirs and rel_path:
+        return True
+    parent = rel_path.rpartition("/")[0]
+    while parent:
+        if parent in dirs:
+            return True
+        parent = parent.rpartition("/")[0]
+    return False
+
+
+def iter_changed_source_tasks(config: Config, reporter: Reporter, rel_paths: list[str]) -> Iterator[FileTask]:
+    for rel_path in rel_paths:
+        source_path = os.path.join(config.source_dir, rel_path)
+        try:
+            source_stat = os.stat(source_path, follow_symlinks=False)
+        except (FileNotFoundError, NotADirectoryError):
+            source_stat = None
+        if source_stat is not None and stat.S_ISREG(source_stat.st_mode):
+            yield build_file_task(config, source_path, rel_path, source_stat)
+            continue
+        if source_stat is not None:
+            kind = "symlink" if stat.S_ISLNK(source_stat.st_mode) else "unsupported file type"
+            print(f"Skipping {kind}: {rel_path}", file=sys.stderr)
+        if reporter.manifest is not None:
+            reporter.manifest.forget(rel_path)
+        if not config.delete_extra:
+            continue
+        target_rel = target_rel_for(rel_path, config.target_suffix)
+        target = stat_target_snapshot(target_rel, os.path.join(config.target_dir, target_rel))
+        if target is None or not stat.S_ISREG(target.mode):
+            continue
+        reporter.handle_outcome(execute_target_work_item(plan_target_only_work(config, target), config, reporter))
+        if not config.dry_run:
+            remove_empty_parents(target.path, config.target_dir)
 
 
 def main(argv: list[str]) -> int:
     ns = parse_args(argv)
+    if ns.worker:
+        return run_worker()
     config = load_config(ns)
-    if ns.internal_convert:
-        run_internal_convert(config, ns.internal_convert)
-        return 0
+    apply_process_priority(config)
+    configure_io_governor(config)
+    install_pause_handlers()
 
     stats = StatsAccumulator()
-    reconciler = execute_tasks(config, traverse_source(config), stats)
-    reconcile_target(reconciler)
-    if not config.hosts_file:
-        Reporter(config, stats).print_summary()
+    metrics = open_metrics_exporter(config, stats)
+    watcher = open_source_watcher(config) if config.watch else None
+    try:
+        reconciler = execute_tasks(config, traverse_source(config), stats, metrics)
+        reconcile_target(reconciler)
+        if watcher is not None:
+            Reporter(config, stats).print_summary()
+            watch_source(config, reconciler.reporter, watcher)
+    except BaseException:
+        if metrics is not None:
+            metrics.write("failed")
+        raise
+    if metrics is not None:
+        metrics.write("completed")
+    Reporter(config, stats).print_summary()
     return 0
 
 